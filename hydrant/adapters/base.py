@@ -0,0 +1,50 @@
+class memoized_property(object):
+    """Read only property computed at most once per adapter instance
+
+    Adapters wrap a single row, and the same attributes are requested
+    to generate the unique key and again to populate the resource.
+    Values are retained in the instance `_memo` dict, so this works with
+    classes defining `__slots__` (unlike `functools.cached_property`).
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return instance._memo[self.name]
+        except KeyError:
+            value = instance._memo[self.name] = self.func(instance)
+            return value
+
+
+class SiteAdapter(object):
+    """Base class for site adapters, each instance wraps a single parsed row
+
+    Subclasses should define `__slots__ = ()` to maintain the small per
+    row footprint, and use `memoized_property` for derived attributes.
+
+    DATE_HEADERS and NAME_HEADERS name the columns parsers normalize,
+    dates to ISO form and names stripped of surrounding white space.
+    """
+    __slots__ = ('data', '_memo')
+    DATE_HEADERS = ()
+    NAME_HEADERS = ()
+
+    def __init__(self, parsed_row):
+        self.data = parsed_row
+        self._memo = {}
+
+    def unique_key(self):
+        """Returns a key value to represent this item as unique
+
+        Defined by adapters wishing to sort out duplicates, used in
+        comparison operators.  Kept compact and hashable (a tuple), as
+        retained for every unique row.  None (the default) keeps every
+        row.
+        """
+        return None
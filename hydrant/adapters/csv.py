@@ -1,56 +1,319 @@
+from collections.abc import Mapping
 import csv
+import gzip
+import io
+from itertools import chain, islice
+import locale
+import mmap
+import sys
 
+from hydrant.models.datetime import normalize_date_string
+
+
+def normalize_row(row, date_columns, name_columns):
+    """Normalize date and name values of a parsed row (dict) in place
+
+    Dates are rewritten in ISO form and names stripped of surrounding
+    white space, as ColumnarCSV_Parser does a column at a time.
+    """
+    for header in date_columns:
+        value = row.get(header)
+        if value:
+            row[header] = normalize_date_string(value)
+    for header in name_columns:
+        value = row.get(header)
+        if value:
+            row[header] = value.strip()
+    return row
 
 class CSV_Serializer(object):
-    def __init__(self, buffer):
-        """Provide buffer (open file, stdout, stringIO) to receive serial data"""
+    def __init__(self, buffer, flush_rows=1000, flush_bytes=1 << 20, compress=False):
+        """Provide buffer (open file, stdout, stringIO) to receive serial data
+
+        Rows are quoted as necessary by a `csv.writer`, and written out to
+        buffer whenever `flush_rows` rows or `flush_bytes` characters are
+        pending, so memory use doesn't grow with the number of rows.
+
+        :param buffer: text buffer to receive data, or binary buffer if
+          `compress` is set
+        :param flush_rows: number of pending rows triggering a flush
+        :param flush_bytes: size of pending data triggering a flush
+        :param compress: set true to gzip output; call `close()` when
+          done to complete the gzip stream
+        """
+        self._gzip = None
+        if compress:
+            self._gzip = gzip.GzipFile(fileobj=buffer, mode='wb')
+            buffer = io.TextIOWrapper(self._gzip, encoding='utf-8', newline='')
         self._io = buffer
         self._headers = None
         self._headers_written = False
-        self._buffer = []
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._pending = 0
 
     def headers(self, col_headers):
         self._headers = col_headers
 
-    def add_row(self, row_data):
-        self._buffer.append(row_data)
-
-    def flush(self):
+    def _write_headers(self):
         if self._headers and not self._headers_written:
-            self._io.write(','.join(self._headers) + '\n')
+            self._writer.writerow(self._headers)
             self._headers_written = True
 
-        for line in self._buffer:
-            self._io.write(','.join(line) + '\n')
+    def add_row(self, row_data):
+        self._write_headers()
+        self._writer.writerow(row_data)
+        self._pending += 1
+        if self._pending >= self.flush_rows or self._buffer.tell() >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        self._write_headers()
+        self._io.write(self._buffer.getvalue())
         self._io.flush()
-        self._buffer = []
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._pending = 0
+
+    def close(self):
+        """Flush pending rows, completing the gzip stream if compressed"""
+        if self._pending or self._headers_written:
+            self.flush()
+        if self._gzip:
+            # closes the gzip stream, leaving the given buffer open
+            self._io.close()
 
 
 class CSV_Parser(object):
+    """Parse delimited text, yielding a dict per row
+
+    Input is opened and its dialect sniffed only once; the dialect and
+    header row are retained for all subsequent use.  Values in
+    `date_columns` are rewritten in ISO form and values in
+    `name_columns` stripped of surrounding white space.
+    """
+    SNIFF_SIZE = 64 * 1024
+
+    def __init__(
+            self, filepath, sniff_size=SNIFF_SIZE, use_mmap=False, encoding=None,
+            dialect=None, opener=None, date_columns=(), name_columns=()):
+        """Initialize parser
 
-    def __init__(self, filepath):
+        :param filepath: path to file, '-' for stdin, or an open text
+          file object (stream) to read from
+        :param sniff_size: approximate size of sample (in whole lines)
+          used to determine the CSV dialect
+        :param use_mmap: set true to read the named file via mmap
+        :param encoding: text encoding, defaults to the locale's
+        :param dialect: CSV dialect, if known; skips sniffing
+        :param opener: function returning a text stream given filepath,
+          in place of `open()`, i.e. to read compressed files
+        :param date_columns: headers of columns holding dates to normalize
+        :param name_columns: headers of columns holding names to normalize
+        """
+        if filepath == '-':
+            filepath = sys.stdin
+        self._file = None
+        self._owns_file = True
+        if hasattr(filepath, 'read'):
+            self._file = filepath
+            self._owns_file = False
+            filepath = getattr(filepath, 'name', None)
         self.filepath = filepath
+        self.sniff_size = sniff_size
+        self.use_mmap = use_mmap
+        self.encoding = encoding
+        self.opener = opener
+        self.date_columns = date_columns
+        self.name_columns = name_columns
         self._headers = None
-        self.csv_dialect = None
+        self.csv_dialect = dialect
+        self._mmap = None
+        self._started = False
+        # line iterator positioned after header row, yet to be consumed
+        self._lines = None
+
+    def seekable(self):
+        """True if rows may be read more than once, i.e. not a pipe"""
+        if self._file is None or self._mmap is not None:
+            return True
+        return self._file.seekable()
+
+    def close(self):
+        """Close the input, if opened by this parser
+
+        Cached dialect and headers are retained; reading rows again will
+        reopen the named file.
+        """
+        if not self._owns_file:
+            return
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lines = None
+        self._started = False
+
+    def __del__(self):
+        # attributes are missing should __init__ have failed
+        if getattr(self, '_owns_file', False):
+            self.close()
+
+    def _restart(self):
+        """Return iterable of lines from the start of input, opening on first use"""
+        if self._mmap is None and self._file is None:
+            if self.opener:
+                self._file = self.opener(self.filepath)
+            elif self.use_mmap:
+                with open(self.filepath, 'rb') as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._file = open(self.filepath, 'r', newline='', encoding=self.encoding)
+        elif self._started:
+            # previously read, rewind
+            if not self.seekable():
+                raise ValueError("input stream can't be read more than once")
+            (self._mmap or self._file).seek(0)
+        self._started = True
+
+        if self._mmap is not None:
+            encoding = self.encoding or locale.getpreferredencoding(False)
+            return (
+                line.decode(encoding) for line in iter(self._mmap.readline, b''))
+        return self._file
+
+    def _start(self):
+        """Position at first row after header, sniffing dialect if unknown"""
+        lines = self._restart()
+        if self.csv_dialect is None:
+            # sample whole lines, retained for use after sniffing
+            sample, size = [], 0
+            # lines in sample ending outside a quoted (multi-line) field
+            complete, quotes = 0, 0
+            for line in lines:
+                sample.append(line)
+                size += len(line)
+                quotes += line.count('"')
+                if quotes % 2 == 0:
+                    complete = len(sample)
+                if size >= self.sniff_size:
+                    break
+            self.csv_dialect = csv.Sniffer().sniff(''.join(sample[:complete or None]))
+            lines = chain(sample, lines)
+        else:
+            lines = iter(lines)
+
+        header = next(csv.reader(lines, dialect=self.csv_dialect), [])
+        if self._headers is None:
+            self._headers = header
+        self._lines = lines
+
+    def _record_lines(self):
+        """Return line iterator, positioned after the header row"""
+        if self._lines is None:
+            self._start()
+        lines, self._lines = self._lines, None
+        return lines
 
     @property
     def headers(self):
-        if self._headers:
-            return self._headers
-
-        with open(self.filepath, 'r') as csv_file:
-            if not self.csv_dialect:
-                self.csv_dialect = csv.Sniffer().sniff(csv_file.read(1024))
-                csv_file.seek(0)
-            reader = csv.DictReader(csv_file, dialect=self.csv_dialect)
-            self._headers = [field for field in reader.fieldnames]
+        if self._headers is None:
+            self._start()
         return self._headers
 
     def rows(self):
-        with open(self.filepath, 'r') as csv_file:
-            if not self.csv_dialect:
-                self.csv_dialect = csv.Sniffer().sniff(csv_file.read(1024))
-                csv_file.seek(0)
-            reader = csv.DictReader(csv_file, dialect=self.csv_dialect)
-            for row in reader:
-                yield row
+        reader = csv.DictReader(
+            self._record_lines(), fieldnames=self.headers, dialect=self.csv_dialect)
+        normalize = self.date_columns or self.name_columns
+        for row in reader:
+            if normalize:
+                normalize_row(row, self.date_columns, self.name_columns)
+            yield row
+        self.close()
+
+
+class RowView(Mapping):
+    """Read only view of a single row within columnar chunk data
+
+    Supports the `data[...]` interface adapters use on parsed rows,
+    without allocating a dict per row.
+    """
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._columns[key][self._index]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __reduce__(self):
+        # pickle (i.e. for worker processes) as a plain dict, not the chunk
+        return dict, (dict(self),)
+
+
+class ColumnarCSV_Parser(CSV_Parser):
+    """CSV parser reading fixed size chunks of rows into column lists
+
+    Date and name columns are normalized as by CSV_Parser, but a column
+    at a time, with each distinct date parsed once.  `rows()` yields
+    RowView instances, compatible with the dicts yielded by CSV_Parser.
+    """
+
+    def __init__(self, filepath, chunk_size=10000, **kwargs):
+        super().__init__(filepath, **kwargs)
+        self.chunk_size = chunk_size
+
+    def chunks(self):
+        """Generate dict of column lists for each chunk of rows"""
+        headers = self.headers
+        width = len(headers)
+        reader = csv.reader(self._record_lines(), dialect=self.csv_dialect)
+        while True:
+            chunk = list(islice(reader, self.chunk_size))
+            if not chunk:
+                break
+            # consistent with DictReader: skip blank rows
+            rows = [row for row in chunk if row]
+            if not rows:
+                continue
+
+            # consistent with DictReader: pad short rows, drop extras
+            rows = [
+                row[:width] if len(row) >= width else row + [None] * (width - len(row))
+                for row in rows]
+            columns = dict(zip(headers, (list(col) for col in zip(*rows))))
+            self.normalize(columns)
+            yield columns, len(rows)
+        self.close()
+
+    def normalize(self, columns):
+        """Normalize date and name columns in place"""
+        for header in self.date_columns:
+            if header not in columns:
+                continue
+            distinct = {
+                value: normalize_date_string(value)
+                for value in set(columns[header]) if value}
+            columns[header] = [distinct.get(value, value) for value in columns[header]]
+
+        for header in self.name_columns:
+            if header not in columns:
+                continue
+            columns[header] = [
+                value.strip() if value else value for value in columns[header]]
+
+    def rows(self):
+        for columns, length in self.chunks():
+            for i in range(length):
+                yield RowView(columns, i)
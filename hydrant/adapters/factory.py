@@ -0,0 +1,202 @@
+"""Locate the parser and site adapter for an input file
+
+Parsers are registered by format, detected from the file's leading
+(magic) bytes.  Site adapters are registered with the column headers
+they require, computed once at registration, and matched against the
+parsed headers.  Installed packages may provide additional site
+adapters via the `hydrant.adapters` entry point group.
+"""
+import csv
+import gzip
+import io
+import zipfile
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # python < 3.8, fall back to setuptools, always installed
+    entry_points = None
+    from pkg_resources import iter_entry_points
+
+from hydrant.adapters.csv import ColumnarCSV_Parser, CSV_Parser
+from hydrant.adapters.sites.dawg import DawgPatientAdapter
+from hydrant.adapters.sites.kent import KentPatientAdapter
+from hydrant.adapters.sites.skagit import (
+    SkagitControlledSubstanceAgreementAdapter,
+    SkagitPatientAdapter,
+    SkagitServiceRequestAdapter,
+)
+from hydrant.adapters.xl import XLS_MAGIC, XLSX_MAGIC, ExcelParser
+
+ENTRY_POINT_GROUP = 'hydrant.adapters'
+
+# format name: function generating a parser given (filepath, **options)
+PARSERS = {}
+
+# adapter class name: (adapter class, frozenset of required headers)
+ADAPTERS = {}
+
+_plugins_loaded = False
+
+
+def register_parser(format_name):
+    """Decorator registering a parser factory function for the named format"""
+    def decorator(factory):
+        PARSERS[format_name] = factory
+        return factory
+    return decorator
+
+
+def register_adapter(adapter_cls):
+    """Register site adapter class, usable as a class decorator"""
+    ADAPTERS[adapter_cls.__name__] = (adapter_cls, frozenset(adapter_cls.headers()))
+    return adapter_cls
+
+
+def load_plugins():
+    """Register site adapters advertised by installed packages, once"""
+    global _plugins_loaded
+    if _plugins_loaded:
+        return
+    _plugins_loaded = True
+
+    if entry_points is None:
+        eps = iter_entry_points(ENTRY_POINT_GROUP)
+    else:
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(ENTRY_POINT_GROUP, [])
+    for entry_point in eps:
+        register_adapter(entry_point.load())
+
+
+def sniff_format(filepath):
+    """Return name of registered format for file, from its content
+
+    :returns: one of `gzip`, `zip`, `xls`, `xlsx`, `tsv` or `csv`
+    """
+    if filepath == '-':
+        # can't peek at stdin without consuming; parser sniffs dialect
+        return 'csv'
+
+    with open(filepath, 'rb') as f:
+        magic = f.read(4)
+        if magic[:2] == b'\x1f\x8b':
+            return 'gzip'
+        if magic == XLS_MAGIC:
+            return 'xls'
+        if magic == XLSX_MAGIC:
+            with zipfile.ZipFile(filepath) as archive:
+                if 'xl/workbook.xml' in archive.namelist():
+                    return 'xlsx'
+            return 'zip'
+
+        f.seek(0)
+        first_line = f.readline()
+    if first_line.count(b'\t') > first_line.count(b','):
+        return 'tsv'
+    return 'csv'
+
+
+def delimited_parser(filepath, columnar=False, chunk_size=10000, **options):
+    """Parser for delimited text, columnar if requested"""
+    if columnar:
+        return ColumnarCSV_Parser(filepath, chunk_size=chunk_size, **options)
+    return CSV_Parser(filepath, **options)
+
+
+@register_parser('csv')
+def csv_parser(filepath, **options):
+    return delimited_parser(filepath, **options)
+
+
+@register_parser('tsv')
+def tsv_parser(filepath, **options):
+    # dialect known, no need to sniff
+    return delimited_parser(filepath, dialect=csv.excel_tab, **options)
+
+
+@register_parser('gzip')
+def gzip_parser(filepath, use_mmap=False, **options):
+    def opener(path):
+        return gzip.open(path, 'rt', newline='', encoding=options.get('encoding'))
+    return delimited_parser(filepath, opener=opener, **options)
+
+
+@register_parser('zip')
+def zip_parser(filepath, use_mmap=False, **options):
+    """Parse the first file in a zip archive, as delimited text"""
+    with zipfile.ZipFile(filepath) as archive:
+        members = [info.filename for info in archive.infolist() if not info.is_dir()]
+    if not members:
+        raise ValueError(f"empty archive {filepath}")
+
+    def opener(path):
+        # the open member retains the archive's file until closed
+        with zipfile.ZipFile(path) as archive:
+            member = archive.open(members[0])
+        return io.TextIOWrapper(member, newline='', encoding=options.get('encoding'))
+    return delimited_parser(filepath, opener=opener, **options)
+
+
+@register_parser('xls')
+@register_parser('xlsx')
+def excel_parser(filepath, **options):
+    return ExcelParser(filepath)
+
+
+def parser_for(filepath, **options):
+    """Return parser for the given file, chosen from its detected format
+
+    :param filepath: path to input file, or '-' for stdin
+    :param options: passed to delimited text parsers, i.e. `columnar`,
+      `chunk_size`, `use_mmap`; ignored by others
+    """
+    return PARSERS[sniff_format(filepath)](filepath, **options)
+
+
+def adapter_for(headers):
+    """Return the one registered site adapter matching column headers
+
+    :raises ValueError: if no adapter, or more than one adapter matches
+    """
+    load_plugins()
+    headers = set(headers)
+    matches = [
+        adapter_cls for adapter_cls, required in ADAPTERS.values()
+        if required.issubset(headers)]
+    if len(matches) > 1:
+        raise ValueError("column headers match multiple adapters")
+    if not matches:
+        raise ValueError("column headers not found in any available adapters")
+    return matches[0]
+
+
+def adapter_by_name(name):
+    """Return registered site adapter class by class name, or None"""
+    load_plugins()
+    if name in ADAPTERS:
+        return ADAPTERS[name][0]
+
+
+def parser_and_adapter(filepath, **options):
+    """Return (parser, adapter class) for given file
+
+    The parser is configured to normalize the adapter's date and name
+    columns.
+    """
+    parser = parser_for(filepath, **options)
+    adapter = adapter_for(parser.headers)
+    parser.date_columns = adapter.DATE_HEADERS
+    parser.name_columns = adapter.NAME_HEADERS
+    return parser, adapter
+
+
+for _adapter in (
+        DawgPatientAdapter,
+        KentPatientAdapter,
+        SkagitPatientAdapter,
+        SkagitControlledSubstanceAgreementAdapter,
+        SkagitServiceRequestAdapter):
+    register_adapter(_adapter)
@@ -1,12 +1,15 @@
-import json
+from hydrant.adapters.base import SiteAdapter, memoized_property
 from hydrant.models.datetime import parse_datetime
 from hydrant.models.patient import Patient
 
 
-class DawgPatientAdapter(object):
+class DawgPatientAdapter(SiteAdapter):
     """Specialized site adapter for UW DAWG site exports"""
+    __slots__ = ()
     RESOURCE_CLASS = Patient
     SITE_SYSTEM = "uwDAL_Clarity"
+    DATE_HEADERS = ('BIRTH_DATE',)
+    NAME_HEADERS = ('PAT_FIRST_NAME', 'PAT_LAST_NAME')
 
     @classmethod
     def headers(cls):
@@ -18,10 +21,7 @@ class DawgPatientAdapter(object):
             'BIRTH_DATE'
         ]
 
-    def __init__(self, parsed_row):
-        self.data = parsed_row
-
-    @property
+    @memoized_property
     def identifier(self):
         """If parsed data include MRN, add a site specific identifier"""
         mrn_field = 'PAT_ID'
@@ -30,14 +30,14 @@ class DawgPatientAdapter(object):
             # FHIR keeps lists of identifiers, return as list
             return [ident]
 
-    @property
+    @memoized_property
     def name(self):
         return {
             "family": self.data['PAT_LAST_NAME'],
             "given": [self.data['PAT_FIRST_NAME']]
             }
 
-    @property
+    @memoized_property
     def birthDate(self):
         if not self.data['BIRTH_DATE']:
             return
@@ -51,9 +51,5 @@ class DawgPatientAdapter(object):
                 yield attr, value
 
     def unique_key(self):
-        """Returns a key value to represent this item as unique
-
-        Defined by adapters wishing to sort out duplicates, used in
-        comparison operators.
-        """
-        return json.dumps([self.name, self.birthDate])
+        """Returns (family, given names, birth date) as unique key"""
+        return self.name['family'], tuple(self.name['given']), self.birthDate
@@ -1,6 +1,6 @@
 from collections import OrderedDict
 import jmespath
-import json
+from hydrant.adapters.base import SiteAdapter, memoized_property
 from hydrant.models.datetime import parse_datetime
 from hydrant.models.document_reference import (
     CONTROLLED_SUBSTANCE_AGREEMENT_CODE,
@@ -38,10 +38,13 @@ def labcorp_code_lookup(labcorp_code):
     return results
 
 
-class SkagitPatientAdapter(object):
+class SkagitPatientAdapter(SiteAdapter):
     """Specialized site adapter for skagit site exports"""
+    __slots__ = ()
     RESOURCE_CLASS = Patient
     SITE_SYSTEM = "SKAGIT"
+    DATE_HEADERS = ('Pat DOB',)
+    NAME_HEADERS = ('Pat First Name', 'Pat Last Name')
 
     @classmethod
     def col_headers_to_fhir_paths(cls):
@@ -53,24 +56,31 @@ class SkagitPatientAdapter(object):
             ('Written by Prov First Name', 'generalPractitioner')
         ])
 
+    @classmethod
+    def compiled_fhir_paths(cls):
+        """Return compiled `col_headers_to_fhir_paths()` expressions, in order
+
+        Compiled once per class, as evaluated for every exported resource.
+        """
+        if '_compiled_fhir_paths' not in cls.__dict__:
+            cls._compiled_fhir_paths = [
+                jmespath.compile(json_path)
+                for json_path in cls.col_headers_to_fhir_paths().values()]
+        return cls._compiled_fhir_paths
+
     @classmethod
     def headers(cls):
         """Return minimal expected header values - extras ignored"""
         return cls.col_headers_to_fhir_paths().keys()
 
-    def __init__(self, parsed_row):
-        self.data = parsed_row
-
     def from_resource(self, resource):
         """Generate class data from FHIR resource form (as opposed to parsing)"""
         assert resource['resourceType'] == self.RESOURCE_CLASS.RESOURCE_TYPE
-        results = []
-        for json_path in self.col_headers_to_fhir_paths().values():
-            value = jmespath.search(json_path, resource) or ""
-            results.append(value)
-        return results
+        return [
+            expression.search(resource) or ""
+            for expression in self.compiled_fhir_paths()]
 
-    @property
+    @memoized_property
     def identifier(self):
         """If parsed data include MRN, add a site specific identifier"""
         if 'Pat MRN' in self.data:
@@ -78,14 +88,14 @@ class SkagitPatientAdapter(object):
             # FHIR keeps lists of identifiers, return as list
             return [ident]
 
-    @property
+    @memoized_property
     def name(self):
         return {
             "family": self.data['Pat Last Name'],
             "given": [self.data['Pat First Name']]
             }
 
-    @property
+    @memoized_property
     def birthDate(self):
         if not self.data['Pat DOB']:
             return
@@ -99,17 +109,16 @@ class SkagitPatientAdapter(object):
                 yield attr, value
 
     def unique_key(self):
-        """Returns a key value to represent this item as unique
-
-        Defined by adapters wishing to sort out duplicates, used in
-        comparison operators.
-        """
-        return json.dumps([self.name, self.birthDate])
+        """Returns (family, given names, birth date) as unique key"""
+        return self.name['family'], tuple(self.name['given']), self.birthDate
 
 
-class SkagitControlledSubstanceAgreementAdapter(object):
+class SkagitControlledSubstanceAgreementAdapter(SiteAdapter):
     """Specialized site adapter for skagit site controlled substance agreement dates"""
+    __slots__ = ()
     RESOURCE_CLASS = DocumentReference
+    DATE_HEADERS = ('Controlled Substance Agreement Date', 'Pat DOB')
+    NAME_HEADERS = ('Pat First Name', 'Pat Last Name')
 
     @classmethod
     def headers(cls):
@@ -121,10 +130,7 @@ class SkagitControlledSubstanceAgreementAdapter(object):
             'Pat DOB',
         ]
 
-    def __init__(self, parsed_row):
-        self.data = parsed_row
-
-    @property
+    @memoized_property
     def name(self):
         """Parsed and used to locate `subject` reference"""
         return {
@@ -132,18 +138,18 @@ class SkagitControlledSubstanceAgreementAdapter(object):
             "given": [self.data['Pat First Name']]
             }
 
-    @property
+    @memoized_property
     def birthDate(self):
         """Parsed and used to locate `subject` reference"""
         if not self.data['Pat DOB']:
             return
         return parse_datetime(self.data['Pat DOB']).date().isoformat()
 
-    @property
+    @memoized_property
     def type(self):
         return {'coding': [CONTROLLED_SUBSTANCE_AGREEMENT_CODE]}
 
-    @property
+    @memoized_property
     def subject(self):
         # Look up matching patient
         patient = Patient(name=self.name, birthDate=self.birthDate)
@@ -153,7 +159,7 @@ class SkagitControlledSubstanceAgreementAdapter(object):
             raise ValueError(f"Request to add {self.RESOURCE_CLASS} for non existing {patient.search_url()}")
         return {"reference": patient.search_url()}
 
-    @property
+    @memoized_property
     def date(self):
         return parse_datetime(self.data['Controlled Substance Agreement Date']).isoformat()
 
@@ -165,17 +171,16 @@ class SkagitControlledSubstanceAgreementAdapter(object):
                 yield attr, value
 
     def unique_key(self):
-        """Returns a key value to represent this item as unique
-
-        Defined by adapters wishing to sort out duplicates, used in
-        comparison operators.
-        """
-        return json.dumps([self.subject, self.type, self.date])
+        """Returns (subject, type code, date) as unique key"""
+        return self.subject['reference'], self.type['coding'][0]['code'], self.date
 
 
-class SkagitServiceRequestAdapter(object):
+class SkagitServiceRequestAdapter(SiteAdapter):
     """Specialized site adapter for skagit site service request exports"""
+    __slots__ = ()
     RESOURCE_CLASS = ServiceRequest
+    DATE_HEADERS = ('Order Date', 'Pat DOB')
+    NAME_HEADERS = ('Pat First Name', 'Pat Last Name')
 
     @classmethod
     def headers(cls):
@@ -188,10 +193,7 @@ class SkagitServiceRequestAdapter(object):
             'Pat DOB',
         ]
 
-    def __init__(self, parsed_row):
-        self.data = parsed_row
-
-    @property
+    @memoized_property
     def name(self):
         """Parsed and used to locate `subject` reference"""
         return {
@@ -199,18 +201,18 @@ class SkagitServiceRequestAdapter(object):
             "given": [self.data['Pat First Name']]
             }
 
-    @property
+    @memoized_property
     def birthDate(self):
         """Parsed and used to locate `subject` reference"""
         if not self.data['Pat DOB']:
             return
         return parse_datetime(self.data['Pat DOB']).date().isoformat()
 
-    @property
+    @memoized_property
     def code(self):
         return labcorp_code_lookup(self.data['Test Code Ordered'])
 
-    @property
+    @memoized_property
     def subject(self):
         # Look up matching patient
         patient = Patient(name=self.name, birthDate=self.birthDate)
@@ -220,7 +222,7 @@ class SkagitServiceRequestAdapter(object):
             raise ValueError(f"Request to add {self.RESOURCE_CLASS} for non existing {patient.search_url()}")
         return {"reference": patient.search_url()}
 
-    @property
+    @memoized_property
     def authoredOn(self):
         return parse_datetime(self.data['Order Date']).isoformat()
 
@@ -232,9 +234,5 @@ class SkagitServiceRequestAdapter(object):
                 yield attr, value
 
     def unique_key(self):
-        """Returns a key value to represent this item as unique
-
-        Defined by adapters wishing to sort out duplicates, used in
-        comparison operators.
-        """
-        return json.dumps([self.subject, self.code, self.authoredOn])
+        """Returns (subject, code, authored date) as unique key"""
+        return self.subject['reference'], self.code['coding'][0]['code'], self.authoredOn
@@ -1,34 +1,121 @@
+from datetime import datetime, time
+
+from openpyxl import load_workbook
 import xlrd
 
+from hydrant.adapters.csv import normalize_row
+
+# leading bytes of legacy (OLE2) `.xls` and zipped (OOXML) `.xlsx` workbooks
+XLS_MAGIC = b'\xd0\xcf\x11\xe0'
+XLSX_MAGIC = b'PK\x03\x04'
+
+
+def cell_string(value):
+    """Render cell value as a string, as found in a CSV export
+
+    Integral numbers drop the decimal, and dates (without a time of
+    day) render as ISO dates.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime):
+        if value.time() == time():
+            return value.date().isoformat()
+        return value.isoformat()
+    return str(value)
+
 
 class ExcelParser(object):
-    """Adapter to read data directly from Excel Workbooks"""
-    def __init__(self, workbook_path):
-        self.workbook = xlrd.open_workbook(workbook_path)
-        self.reset()
+    """Adapter to read data directly from Excel Workbooks
+
+    Exposes the same `headers` / `rows()` interface as CSV_Parser,
+    yielding a dict per row as each row is read.  Legacy `.xls`
+    workbooks are read with xlrd, loading only the requested sheet;
+    `.xlsx` workbooks are streamed with openpyxl in read only mode.
+    """
 
-    def reset(self):
+    def __init__(self, workbook_path, sheet_index=0, date_columns=(), name_columns=()):
+        self.workbook_path = workbook_path
+        self.sheet_index = sheet_index
+        # columns normalized as by CSV_Parser
+        self.date_columns = date_columns
+        self.name_columns = name_columns
+        self._headers = None
+        # mapping of header value to column index
         self.header = {}
-        self.rows = []
-
-    def parse_sheet(self, index=0):
-        """Parse given sheet
-
-        Populates internal header and row data.
-        """
-        if self.header or self.rows:
-            raise ValueError(
-                "Parsing over top of populated values; "
-                "call purge() to reuse parser on second sheet")
-
-        worksheet = self.workbook.sheet_by_index(index)
-        for i, row in enumerate(range(worksheet.nrows)):
-            if i == 0:
-                for j, col in enumerate(range(worksheet.ncols)):
-                    # build mapping of header value to col index
-                    self.header[(worksheet.cell_value(i, j))] = i
-            else:
-                r = []
-                for j, col in enumerate(range(worksheet.ncols)):
-                    r.append(worksheet.cell_value(i, j))
-                self.rows.append(r)
+
+        with open(workbook_path, 'rb') as f:
+            magic = f.read(4)
+        if magic == XLS_MAGIC:
+            self._values = self._xls_values
+        elif magic == XLSX_MAGIC:
+            self._values = self._xlsx_values
+        else:
+            raise ValueError(f"{workbook_path} is not an Excel workbook")
+
+    def seekable(self):
+        """Rows may be read more than once"""
+        return True
+
+    def close(self):
+        pass
+
+    def _xls_values(self):
+        """Generate list of cell values for each row of a legacy workbook"""
+        workbook = xlrd.open_workbook(self.workbook_path, on_demand=True)
+        try:
+            worksheet = workbook.sheet_by_index(self.sheet_index)
+            for i in range(worksheet.nrows):
+                values = []
+                for cell in worksheet.row(i):
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        values.append(xlrd.xldate_as_datetime(cell.value, workbook.datemode))
+                    else:
+                        values.append(cell.value)
+                yield values
+        finally:
+            workbook.release_resources()
+
+    def _xlsx_values(self):
+        """Generate tuple of cell values for each row, streaming the workbook"""
+        workbook = load_workbook(self.workbook_path, read_only=True, data_only=True)
+        try:
+            worksheet = workbook.worksheets[self.sheet_index]
+            for values in worksheet.iter_rows(values_only=True):
+                yield values
+        finally:
+            workbook.close()
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            values = self._values()
+            try:
+                first = next(values, ())
+            finally:
+                values.close()
+            self._headers = [cell_string(value) for value in first]
+            self.header = {value: j for j, value in enumerate(self._headers)}
+        return self._headers
+
+    def rows(self):
+        headers = self.headers
+        values = self._values()
+        # skip header row
+        next(values, None)
+        normalize = self.date_columns or self.name_columns
+        for row in values:
+            cells = [cell_string(value) for value in row]
+            if not any(cells):
+                # consistent with CSV_Parser, skip blank rows
+                continue
+            # pad short rows, as `DictReader` does
+            cells.extend([None] * (len(headers) - len(cells)))
+            row = dict(zip(headers, cells))
+            if normalize:
+                normalize_row(row, self.date_columns, self.name_columns)
+            yield row
@@ -4,15 +4,25 @@ functions to simplify adding context and extra data to log messages destined for
 """
 import logging
 
-from hydrant.logserverhandler import LogServerHandler
+from hydrant.logserverhandler import BatchingLogServerHandler, LogServerHandler
 
 EVENT_LOG_NAME = "hydrant_event_logger"
 
 
 def audit_log_init(app):
-    log_server_handler = LogServerHandler(
-        jwt=app.config['LOGSERVER_TOKEN'],
-        url=app.config['LOGSERVER_URL'])
+    if app.config['LOGSERVER_ASYNC']:
+        log_server_handler = BatchingLogServerHandler(
+            jwt=app.config['LOGSERVER_TOKEN'],
+            url=app.config['LOGSERVER_URL'],
+            batch_size=app.config['LOGSERVER_BATCH_SIZE'],
+            flush_interval=app.config['LOGSERVER_FLUSH_INTERVAL'],
+            max_queue=app.config['LOGSERVER_MAX_QUEUE'],
+            timeout=app.config['LOGSERVER_TIMEOUT'])
+    else:
+        log_server_handler = LogServerHandler(
+            jwt=app.config['LOGSERVER_TOKEN'],
+            url=app.config['LOGSERVER_URL'],
+            timeout=app.config['LOGSERVER_TIMEOUT'])
     event_logger = logging.getLogger(EVENT_LOG_NAME)
     event_logger.setLevel(logging.INFO)
     event_logger.addHandler(log_server_handler)
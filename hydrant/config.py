@@ -9,7 +9,55 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 # URL scheme to use outside of request context
 PREFERRED_URL_SCHEME = os.getenv("PREFERRED_URL_SCHEME", 'http')
 FHIR_SERVER_URL = os.getenv('FHIR_SERVER_URL')
+# HTTP connection pool and retry behavior for FHIR (and log server) traffic
+FHIR_POOL_SIZE = int(os.getenv("FHIR_POOL_SIZE", "10"))
+FHIR_CONNECT_TIMEOUT = float(os.getenv("FHIR_CONNECT_TIMEOUT", "10"))
+FHIR_READ_TIMEOUT = float(os.getenv("FHIR_READ_TIMEOUT", "300"))
+FHIR_RETRIES = int(os.getenv("FHIR_RETRIES", "3"))
+FHIR_RETRY_BACKOFF = float(os.getenv("FHIR_RETRY_BACKOFF", "0.5"))
 UPLOAD_BUNDLE_SIZE = int(os.getenv("UPLOAD_BUNDLE_SIZE", "20"))
+# Bounds within which bundle size is tuned at runtime, starting from
+# UPLOAD_BUNDLE_SIZE; fixed at UPLOAD_BUNDLE_SIZE unless set apart (opt-in)
+UPLOAD_BUNDLE_SIZE_MIN = int(os.getenv("UPLOAD_BUNDLE_SIZE_MIN", str(UPLOAD_BUNDLE_SIZE)))
+UPLOAD_BUNDLE_SIZE_MAX = int(os.getenv("UPLOAD_BUNDLE_SIZE_MAX", str(UPLOAD_BUNDLE_SIZE)))
+# Transaction latency (seconds) and payload size adaptive bundles aim within
+UPLOAD_TARGET_LATENCY = float(os.getenv("UPLOAD_TARGET_LATENCY", "5"))
+UPLOAD_MAX_BUNDLE_BYTES = int(os.getenv("UPLOAD_MAX_BUNDLE_BYTES", str(4 << 20)))
+# Upload `transaction` (all or nothing) or `batch` (independent entries) bundles
+UPLOAD_BUNDLE_TYPE = os.getenv("UPLOAD_BUNDLE_TYPE", "transaction")
+# Path to NDJSON file retaining rejected entries; when set, failing
+# transactions are bisected to reject only the failing entries
+UPLOAD_REJECT_FILE = os.getenv("UPLOAD_REJECT_FILE")
+# Number of bundles concurrently in flight during upload; 1 for sequential
+UPLOAD_MAX_IN_FLIGHT = int(os.getenv("UPLOAD_MAX_IN_FLIGHT", "1"))
+
+# Patient id lookups cached for the duration of an upload run
+PATIENT_CACHE_SIZE = int(os.getenv("PATIENT_CACHE_SIZE", "10000"))
+# Set true to also cache patients not found (negative caching)
+PATIENT_CACHE_MISSES = os.getenv("PATIENT_CACHE_MISSES", "false").lower() == "true"
+# Patient searches per batch Bundle when prefetching ids; 0 to disable
+PATIENT_PREFETCH_BATCH_SIZE = int(os.getenv("PATIENT_PREFETCH_BATCH_SIZE", "100"))
+
+# Worker processes transforming rows during upload; 1 to transform in process
+UPLOAD_PROCESSES = int(os.getenv("UPLOAD_PROCESSES", "1"))
+# Rows sent to each worker process at a time
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", "500"))
+# Set true to parse upload files in chunks of columns (see ColumnarCSV_Parser)
+UPLOAD_COLUMNAR = os.getenv("UPLOAD_COLUMNAR", "false").lower() == "true"
+UPLOAD_COLUMNAR_CHUNK_SIZE = int(os.getenv("UPLOAD_COLUMNAR_CHUNK_SIZE", "10000"))
+# Store for unique keys seen during upload dedup, `memory` or `sqlite` (on disk)
+UPLOAD_DEDUP_STORE = os.getenv("UPLOAD_DEDUP_STORE", "memory")
+# Path to sqlite ledger of uploaded resources; when set, resources unchanged
+# since their last upload are skipped (incremental uploads)
+UPLOAD_LEDGER = os.getenv("UPLOAD_LEDGER")
+# Path to checkpoint file, saving upload progress to resume from if interrupted
+UPLOAD_CHECKPOINT = os.getenv("UPLOAD_CHECKPOINT")
+
+# Pages of search results requested ahead while exporting; 0 to disable
+EXPORT_READ_AHEAD = int(os.getenv("EXPORT_READ_AHEAD", "2"))
+# Export rows are written out once either threshold (rows, bytes) is reached
+EXPORT_FLUSH_ROWS = int(os.getenv("EXPORT_FLUSH_ROWS", "1000"))
+EXPORT_FLUSH_BYTES = int(os.getenv("EXPORT_FLUSH_BYTES", str(1 << 20)))
 
 # Used to access keycloak db for event log extraction
 DB_VENDOR = os.getenv("DB_VENDOR", "postgres")
@@ -18,9 +66,28 @@ DB_PORT = os.getenv("DB_PORT", "5432")
 DB_DATABASE = os.getenv("DB_DATABASE", "keycloak")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
+# Bounds of the keycloak db connection pool
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "4"))
+# Keycloak db statements cancelled after the given milliseconds; 0 for no limit
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "300000"))
+# Keycloak event rows fetched per round trip while extracting
+KC_EVENTS_ITERSIZE = int(os.getenv("KC_EVENTS_ITERSIZE", "2000"))
+# Path to state file retaining the last event extracted, for incremental runs
+KC_EVENTS_STATE_FILE = os.getenv("KC_EVENTS_STATE_FILE")
 
 LOGSERVER_TOKEN = os.getenv('LOGSERVER_TOKEN')
 LOGSERVER_URL = os.getenv('LOGSERVER_URL')
+# Set true to queue log server events, sent in batches by a background thread
+LOGSERVER_ASYNC = os.getenv("LOGSERVER_ASYNC", "false").lower() == "true"
+LOGSERVER_BATCH_SIZE = int(os.getenv("LOGSERVER_BATCH_SIZE", "100"))
+LOGSERVER_FLUSH_INTERVAL = float(os.getenv("LOGSERVER_FLUSH_INTERVAL", "2"))
+LOGSERVER_MAX_QUEUE = int(os.getenv("LOGSERVER_MAX_QUEUE", "10000"))
+# Connect and read timeout (seconds) of each POST to the log server
+LOGSERVER_TIMEOUT = float(os.getenv("LOGSERVER_TIMEOUT", "10"))
+# Batches concurrently in flight, and retries per batch, shipping Keycloak events
+LOGSERVER_MAX_IN_FLIGHT = int(os.getenv("LOGSERVER_MAX_IN_FLIGHT", "2"))
+LOGSERVER_RETRIES = int(os.getenv("LOGSERVER_RETRIES", "3"))
 
 # NB log level hardcoded at INFO for logserver
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG').upper()
@@ -0,0 +1,82 @@
+"""FHIR client
+
+Shared, pooled HTTP session for all FHIR server (and log server) traffic.
+Connections are kept alive between requests, and idempotent requests are
+retried with exponential backoff on throttling or server errors.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from hydrant.config import (
+    FHIR_CONNECT_TIMEOUT,
+    FHIR_POOL_SIZE,
+    FHIR_READ_TIMEOUT,
+    FHIR_RETRIES,
+    FHIR_RETRY_BACKOFF,
+)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def build_session(
+        pool_size=FHIR_POOL_SIZE,
+        retries=FHIR_RETRIES,
+        backoff_factor=FHIR_RETRY_BACKOFF):
+    """Build a requests Session with connection pooling and retry
+
+    Only idempotent methods (i.e. GET, PUT, DELETE) are retried on
+    status codes in RETRY_STATUS_CODES; after the final attempt the
+    response is returned for the caller to check.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def session():
+    """Return the shared session, built on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = build_session()
+    return _session
+
+
+def reset_session():
+    """Discard the shared session, rebuilt on next use
+
+    For use in a forked (child) process, such that it never shares the
+    parent's pooled connections.  The inherited session is dropped, not
+    closed, as closing would act on the parent's sockets too.
+    """
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+def request(method, url, **kwargs):
+    """Issue request via the shared session, applying configured timeouts"""
+    kwargs.setdefault('timeout', (FHIR_CONNECT_TIMEOUT, FHIR_READ_TIMEOUT))
+    return session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -1,31 +1,218 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
 import json
 import logging
+import queue
+import threading
+import time
 from pythonjsonlogger.jsonlogger import JsonFormatter
-import requests
 from requests.exceptions import RequestException
 
+from hydrant import fhir_client
+
 
 class LogServerHandler(logging.Handler):
-    """Specialized logging handler capable of nesting json and passing auth"""
+    """Specialized logging handler capable of nesting json and passing auth
+
+    Posts via the shared FHIR session, but with its own (short) `timeout`
+    in seconds, so an unresponsive log server doesn't stall logging.
+    """
 
-    def __init__(self, url, jwt):
+    def __init__(self, url, jwt, timeout=10.0):
         super().__init__()
         self.jwt = jwt
         self.url = f"{url}/events"
+        self.timeout = timeout
         self.setFormatter(JsonFormatter(
             "%(asctime)s %(name)s %(levelname)s %(message)s"))
 
-    def emit(self, record):
+    def prepare(self, record):
+        """Format record into the log server's event payload"""
         log_entry = self.format(record)
-        log_entry = {"event": json.loads(log_entry)}
+        return {"event": json.loads(log_entry)}
+
+    def transmit(self, payload):
+        """POST payload (a single event, or list of events) to the log server"""
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.jwt}"
         }
         try:
-            response = requests.post(url=self.url, headers=headers, json=log_entry)
+            response = fhir_client.post(
+                url=self.url, headers=headers, json=payload, timeout=self.timeout)
             response.raise_for_status()
         except RequestException as ex:
             # bootstrap problems - attempt to log to root logger
             root_logger = logging.getLogger('root')
             root_logger.exception(ex)
+            return False
+        return True
+
+    def emit(self, record):
+        self.transmit(self.prepare(record))
+
+
+class BatchingLogServerHandler(LogServerHandler):
+    """LogServerHandler queueing records for transmission in batches
+
+    Rather than POST each record within the logging call, records are
+    queued and sent by a background worker once `batch_size` records are
+    waiting or `flush_interval` seconds have passed since the first.
+    When the bounded queue is full, records are dropped and counted.
+    Queued records are sent on `flush()` and `close()`, both of which
+    `logging.shutdown()` calls at interpreter exit.  Both signal the
+    worker via events rather than the queue, so never block on (or fail
+    with) a full queue.
+    """
+    # worker checks for flush / close requests at least this often (seconds)
+    POLL_INTERVAL = 0.1
+
+    def __init__(
+            self, url, jwt, batch_size=100, flush_interval=2.0, max_queue=10000,
+            timeout=10.0):
+        super().__init__(url=url, jwt=jwt, timeout=timeout)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        # events set once queued records are sent, one per pending flush()
+        self._flush_waiters = []
+        self._flush_lock = threading.Lock()
+        self._worker = threading.Thread(
+            target=self._run, name="LogServerHandler", daemon=True)
+        self._worker.start()
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=30):
+        """Block until records queued before this call have been sent"""
+        if not self._worker.is_alive():
+            return
+        flushed = threading.Event()
+        with self._flush_lock:
+            self._flush_waiters.append(flushed)
+        flushed.wait(timeout=timeout)
+
+    def close(self, timeout=30):
+        if self._worker.is_alive():
+            self._stop.set()
+            self._worker.join(timeout=timeout)
+            if self.dropped:
+                logging.getLogger('root').warning(
+                    f"LogServerHandler dropped {self.dropped} records on full queue")
+        super().close()
+
+    def _send(self, batch):
+        if not batch:
+            return
+        if self.transmit(batch):
+            self.sent += len(batch)
+        else:
+            self.failed += len(batch)
+
+    def _drain(self, batch):
+        """Send batch and every record queued, in batches"""
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._send(batch)
+                batch = []
+        self._send(batch)
+
+    def _run(self):
+        """Worker loop, sending batches on size or time threshold"""
+        batch, deadline = [], None
+        while True:
+            timeout = self.POLL_INTERVAL
+            if deadline is not None:
+                timeout = min(timeout, max(0, deadline - time.monotonic()))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            stopping = self._stop.is_set()
+            with self._flush_lock:
+                flushed, self._flush_waiters = self._flush_waiters, []
+            if stopping or flushed:
+                self._drain(batch)
+                batch, deadline = [], None
+                for event in flushed:
+                    event.set()
+                if stopping:
+                    return
+            elif len(batch) >= self.batch_size or (
+                    batch and time.monotonic() >= deadline):
+                self._send(batch)
+                batch, deadline = [], None
+
+
+class EventShipper(object):
+    """Ship a stream of events (dictionaries) to the log server in batches
+
+    Events are wrapped as `{"event": event}` and POSTed `batch_size` at
+    a time via the given LogServerHandler, with up to `max_in_flight`
+    batches sent concurrently over the pooled session.  A failing batch
+    is retried with exponential backoff; should it still fail, no
+    further batches are sent, and its events are counted in `failed`.
+    """
+
+    def __init__(self, handler, batch_size=100, max_in_flight=2, retries=3, backoff_factor=0.5):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.sent = 0
+        self.failed = 0
+
+    def ship(self, events):
+        """Ship all events, returning count sent"""
+        events = iter(events)
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while True:
+                # backpressure - wait for a free slot before sending another
+                while len(in_flight) >= self.max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self._tally(done)
+                if self.failed:
+                    break
+                batch = [{"event": event} for event in islice(events, self.batch_size)]
+                if not batch:
+                    break
+                in_flight.add(executor.submit(self._send, batch))
+            self._tally(wait(in_flight).done)
+        return self.sent
+
+    def _send(self, batch):
+        """Transmit batch, retrying on failure; returns (count, success)"""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+            if self.handler.transmit(batch):
+                return len(batch), True
+        return len(batch), False
+
+    def _tally(self, done):
+        for future in done:
+            count, success = future.result()
+            if success:
+                self.sent += count
+            else:
+                self.failed += count
@@ -1,8 +1,25 @@
+from collections import OrderedDict
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
 import logging
 from datetime import datetime
+import jmespath
+from json import JSONDecodeError
+import queue
 import requests
+import threading
+import time
 
+from hydrant import fhir_client
 from hydrant.audit import audit_entry
+from hydrant.models.rejects import response_outcome
+
+# compiled once, as evaluated for every page of search results
+NEXT_LINK_EXPRESSION = jmespath.compile("link[?relation=='next'].{url: url}")
 
 
 class Bundle(object):
@@ -44,7 +61,10 @@ class Bundle(object):
             if 'resourceType' not in data:
                 raise ValueError(f"ill formed bundle entry: {data}")
 
-        if 'resource' not in entry_or_resource:
+        if 'resource' not in entry_or_resource and 'request' in entry_or_resource:
+            # batch requests such as a search (GET) don't include a resource
+            entry = entry_or_resource
+        elif 'resource' not in entry_or_resource:
             # Bundles nest each entry under a 'resource'
             validate_resource_type(entry_or_resource)
             entry = {'resource': entry_or_resource}
@@ -55,20 +75,202 @@ class Bundle(object):
         self.entries.append(entry)
 
     def as_fhir(self):
-        results = self.template
+        # copy, as the class level template is shared by all instances
+        results = dict(self.template)
+        results.update({'type': self.bundle_type})
         results.update({'entry': self.entries})
         results.update({'total': len(self.entries)})
         return results
 
 
+def next_page_url(bundle, target_system):
+    """Return URL for the next page of a searchset bundle, None if last
+
+    :param bundle: searchset Bundle, as returned from the FHIR server
+    :param target_system: configured FHIR server URL, used in place of
+      the server portion of the `next` link
+    """
+    next_page_link = NEXT_LINK_EXPRESSION.search(bundle)
+    if not next_page_link:
+        return
+
+    # HAPI server config uses a `dashboard` protected URL, which we can't write to.
+    #   see: https://github.com/uwcirg/cosri-environments/pull/56
+    # correct server portion of `next` to configured `FHIR_SERVER_URL`,
+    # relying on `/fhir` request path in both
+    expected_request_path_base = '/fhir'
+    assert target_system.endswith(expected_request_path_base)
+    if next_page_link[0]['url'].count(expected_request_path_base) != 1:
+        raise ValueError(
+            f"missing expected request path {expected_request_path_base} "
+            f"in next page url {next_page_link[0]['url']}")
+
+    _, requestpath = next_page_link[0]['url'].split(expected_request_path_base)
+    return target_system + requestpath
+
+
+class SearchError(ValueError):
+    """Raised when a page of search results can't be fetched or followed"""
+
+
+class SearchsetPages(object):
+    """Iterate over the pages (searchset Bundles) of a FHIR search
+
+    With a positive `read_ahead`, a background thread requests the
+    following pages while the current is consumed, holding at most
+    `read_ahead` pages not yet consumed.  Pages are always yielded in
+    order; iteration ends after the last page, or the first page
+    without entries.  Pages that can't be fetched, or linked to the
+    next, raise SearchError.
+    """
+    _DONE = object()
+
+    def __init__(self, search_url, target_system, read_ahead=2):
+        self.search_url = search_url
+        self.target_system = target_system
+        self.read_ahead = read_ahead
+
+    def __iter__(self):
+        if self.read_ahead < 1:
+            return self.pages()
+        return self._read_ahead_pages()
+
+    def fetch(self, url):
+        response = fhir_client.get(url)
+        try:
+            return response.json()
+        except JSONDecodeError:
+            raise SearchError(f"{response.status_code} FROM {url} - {response.text}")
+
+    def pages(self):
+        """Generate each page in turn, requesting next only when needed"""
+        url = self.search_url
+        while url:
+            bundle = self.fetch(url)
+            yield bundle
+            if 'entry' not in bundle:
+                break
+            try:
+                url = next_page_url(bundle, self.target_system)
+            except ValueError as error:
+                raise SearchError(str(error)) from error
+
+    def _read_ahead_pages(self):
+        pages = queue.Queue(maxsize=self.read_ahead)
+        stop = threading.Event()
+
+        def put(item):
+            # blocks while read ahead is full, unless consumer has quit
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
+            try:
+                for bundle in self.pages():
+                    put(bundle)
+                    if stop.is_set():
+                        return
+            except Exception as ex:
+                put(ex)
+            put(self._DONE)
+
+        producer = threading.Thread(target=produce, name="SearchsetPages", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is self._DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+
 class BatchUpload(object):
-    """Upload a series of Bundles"""
+    """Upload a series of Bundles
+
+    By default, each Bundle is transmitted synchronously.  With
+    `max_in_flight` above one, Bundles are posted concurrently from a
+    thread pool, blocking additional Bundles until a slot frees up.
+
+    Given an UploadLedger, resources unchanged since their last upload
+    are skipped (unless `force` is set), and the entries of each Bundle
+    accepted are recorded.
 
-    def __init__(self, target_system, batch_size=20):
-        self.bundle = Bundle()
+    Given an UploadCheckpoint, progress is saved as Bundles are
+    committed: the count of Bundles and of input rows (per the
+    `rows_read` of the ResourceList uploaded) for which every Bundle
+    is committed.
+
+    With `min_batch_size` below `max_batch_size`, the Bundle size is
+    adaptive, tuned after each Bundle within those bounds: grown while
+    transactions complete well within `target_latency` seconds, reduced
+    in proportion when slower, and capped such that the estimated
+    payload stays within `max_bundle_bytes`.  A Bundle rejected as too
+    large (413) or failing on its payload (500) halves the Bundle size,
+    and is itself split in half and retried to isolate the failing
+    entries, which are audited and tallied in `total_failed`.  Should
+    every entry of such a Bundle fail with 500, the server is taken to
+    be failing regardless of content, and the error raised.  A Bundle
+    refused while the server is unavailable (502, 503, 504) also halves
+    the Bundle size, and is retried whole up to `retries` times with
+    exponential backoff, before the error is raised.
+
+    Set `bundle_type` to `batch` for the server to process each entry
+    independently; entries failing per the batch-response are rejected,
+    while the rest are committed.  Given a RejectFile, a `transaction`
+    failing on its content (i.e. 400, 409, 412, 422) is likewise split
+    in half and retried to isolate the failing entries.  Rejected
+    entries are tallied in `total_failed`, and written with the
+    OperationOutcome returned to the RejectFile, if given.
+    """
+    SPLIT_STATUS_CODES = (413, 500)
+    UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+    REJECT_STATUS_CODES = (400, 409, 412, 422)
+
+    def __init__(
+            self, target_system, batch_size=20, max_in_flight=1, ledger=None,
+            force=False, checkpoint=None, min_batch_size=None, max_batch_size=None,
+            target_latency=None, max_bundle_bytes=None, bundle_type='transaction',
+            rejects=None, retries=3, backoff_factor=0.5):
+        if bundle_type not in ('transaction', 'batch'):
+            raise ValueError(f"unsupported bundle type: {bundle_type}")
+        self.bundle_type = bundle_type
+        self.rejects = rejects
+        self.bundle = Bundle(bundle_type=bundle_type)
         self.target_system = target_system
         self.batch_size = batch_size
+        self.min_batch_size = min_batch_size or batch_size
+        self.max_batch_size = max_batch_size or batch_size
+        self.target_latency = target_latency
+        self.max_bundle_bytes = max_bundle_bytes
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_in_flight = max_in_flight
+        self.ledger = ledger
+        self.force = force
+        self.checkpoint = checkpoint
         self.total_sent = 0
+        self.total_unchanged = 0
+        self.total_failed = 0
+        self.bundles_committed = checkpoint.bundles if checkpoint is not None else 0
+        self.rows_read = checkpoint.rows if checkpoint is not None else 0
+        # bundles sent, in order, with input rows read when sent and
+        # whether committed; popped once all prior are also committed
+        self._uncommitted = OrderedDict()
+        self._executor = None
+        self._in_flight = {}
+
+    @property
+    def adaptive(self):
+        return self.min_batch_size < self.max_batch_size
 
     def add_entry(self, item):
         self.bundle.add_entry(item)
@@ -76,29 +278,234 @@ class BatchUpload(object):
             self.transmit_bundle()
 
     def process(self, resources):
-        for r in resources:
-            self.add_entry(r.as_upsert_entry())
-        # catch the last bundle not yet sent
-        self.transmit_bundle()
+        try:
+            for r in resources:
+                # input rows consumed through this resource, for checkpoints
+                self.rows_read = getattr(resources, 'rows_read', self.rows_read)
+                entry = r.as_upsert_entry()
+                if self.ledger is not None and not self.force and self.ledger.unchanged(entry):
+                    self.total_unchanged += 1
+                    continue
+                self.add_entry(entry)
+            # catch the last bundle not yet sent
+            self.rows_read = getattr(resources, 'rows_read', self.rows_read)
+            self.transmit_bundle()
+        except Exception:
+            # report on every bundle still in flight before raising
+            self.drain(raise_errors=False)
+            raise
+        self.drain()
 
     def transmit_bundle(self):
         if len(self.bundle) == 0:
             return
 
-        fhir_bundle = self.bundle.as_fhir()
+        bundle = self.bundle
+        fhir_bundle = bundle.as_fhir()
+
+        # reset internal state for next bundle
+        self.bundle = Bundle(bundle_type=self.bundle_type)
+        self._uncommitted[bundle] = [self.rows_read, False]
+
+        if self.max_in_flight <= 1:
+            self._complete(bundle, fhir_bundle, self._post(fhir_bundle))
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+        # backpressure - wait for a free slot before sending another
+        while len(self._in_flight) >= self.max_in_flight:
+            self._wait(return_when=FIRST_COMPLETED)
+
+        future = self._executor.submit(self._post, fhir_bundle)
+        self._in_flight[future] = (bundle, fhir_bundle)
+
+    def drain(self, raise_errors=True):
+        """Wait on all bundles in flight
+
+        :param raise_errors: set false to only report (audit) errors,
+          otherwise the first error seen is raised
+        """
+        try:
+            if self._in_flight:
+                self._wait(return_when=ALL_COMPLETED)
+        except Exception:
+            if raise_errors:
+                raise
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _wait(self, return_when):
+        """Wait on bundles in flight, completing each one done
+
+        Every completed bundle is reported before raising the first
+        error encountered.
+        """
+        done, _ = wait(self._in_flight, return_when=return_when)
+        first_error = None
+        for future in done:
+            bundle, fhir_bundle = self._in_flight.pop(future)
+            try:
+                self._complete(bundle, fhir_bundle, future.result())
+            except Exception as ex:
+                first_error = first_error or ex
+        if first_error:
+            raise first_error
+
+    def _commit(self, bundle):
+        """Mark bundle committed, saving progress through the last in order"""
+        self._uncommitted[bundle][1] = True
+        rows = None
+        while self._uncommitted:
+            first = next(iter(self._uncommitted))
+            first_rows, committed = self._uncommitted[first]
+            if not committed:
+                break
+            del self._uncommitted[first]
+            self.bundles_committed += 1
+            rows = first_rows
+        if rows is not None and self.checkpoint is not None:
+            self.checkpoint.save(bundles=self.bundles_committed, rows=rows)
+
+    def _post(self, fhir_bundle):
         logging.info(f"  - uploading next bundle to {self.target_system}")
-        response = requests.post(self.target_system, json=fhir_bundle)
+        return fhir_client.post(self.target_system, json=fhir_bundle)
+
+    def _complete(self, bundle, fhir_bundle, response):
+        """Check response from transmitting bundle, audit and tally results"""
+        response = self._retry_unavailable(fhir_bundle, response)
+        if self._bisect_on(response):
+            sent = self._bisect(bundle, response)
+            if not sent and response.status_code == 500:
+                audit_entry(
+                    f"every entry failed with {response.status_code}, "
+                    f"aborting upload to {self.target_system}", level="error")
+                response.raise_for_status()
+            self._commit(bundle)
+            return
+
+        self._accept(bundle, fhir_bundle, response)
+        self._commit(bundle)
+
+    def _accept(self, bundle, fhir_bundle, response, tune=True):
+        """Check response to a bundle, raising on error, else tally results
+
+        :param tune: set false to leave bundle size as is, i.e. for the
+          parts of a bisected bundle
+        :returns: count of entries successfully sent
+        """
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError as http_err:
             # at least one item in the bundle generated an error
-            audit_entry(f"response: {response.json()['issue']}", level="error")
+            outcome = response_outcome(response)
+            audit_entry(
+                f"response: {outcome['issue'] if outcome else response.text}", level="error")
             audit_entry(f"fhir_bundle which generated errors: {fhir_bundle}")
             raise http_err
 
-        self.total_sent += len(self.bundle)
+        entries = bundle.entries
+        if bundle.bundle_type == 'batch':
+            entries = self._batch_results(bundle, response.json())
+        self.total_sent += len(entries)
+        if self.ledger is not None:
+            self.ledger.record(entries)
+        if self.adaptive and tune:
+            self._tune(
+                len(bundle),
+                latency=response.elapsed.total_seconds(),
+                payload_bytes=len(response.request.body or b''))
         extra = {'tags': ['upload'], 'system': self.target_system, 'user': 'system'}
         audit_entry(f"uploaded: {response.json()}", extra=extra)
+        return len(entries)
 
-        # reset internal state for next bundle
-        self.bundle = Bundle()
+    def _retry_unavailable(self, fhir_bundle, response):
+        """Retry whole bundle, with backoff, while the server is unavailable
+
+        Only for adaptive bundles; returns the last response received.
+        """
+        if not self.adaptive:
+            return response
+        for attempt in range(self.retries):
+            if response.status_code not in self.UNAVAILABLE_STATUS_CODES:
+                break
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            time.sleep(self.backoff_factor * (2 ** attempt))
+            response = self._post(fhir_bundle)
+        return response
+
+    def _bisect_on(self, response):
+        """Determine if the bundle given response should be bisected"""
+        if self.adaptive and response.status_code in self.SPLIT_STATUS_CODES:
+            return True
+        return self.rejects is not None and response.status_code in self.REJECT_STATUS_CODES
+
+    def _bisect(self, bundle, response):
+        """Retry halves of a bundle the server failed on
+
+        Halves are sent synchronously, splitting again as needed until
+        single entries, each failing one is rejected.  Bundle size is
+        halved (backed off) on 413 or 500 responses.
+
+        :returns: count of entries successfully sent
+        """
+        if response.status_code in self.SPLIT_STATUS_CODES:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        if len(bundle) == 1:
+            self._reject(
+                bundle.entries[0], str(response.status_code), response_outcome(response))
+            return 0
+
+        sent = 0
+        middle = len(bundle) // 2
+        for entries in (bundle.entries[:middle], bundle.entries[middle:]):
+            half = Bundle(bundle_type=bundle.bundle_type)
+            half.entries = entries
+            fhir_bundle = half.as_fhir()
+            response = self._retry_unavailable(fhir_bundle, self._post(fhir_bundle))
+            if self._bisect_on(response):
+                sent += self._bisect(half, response)
+            else:
+                sent += self._accept(half, fhir_bundle, response, tune=False)
+        return sent
+
+    def _batch_results(self, bundle, batch_response):
+        """Reject entries failing per the batch-response, return the rest"""
+        results = batch_response.get('entry', [])
+        if len(results) != len(bundle):
+            raise ValueError(
+                f"batch-response holds {len(results)} entries, {len(bundle)} sent")
+        succeeded = []
+        for entry, result in zip(bundle.entries, results):
+            entry_response = result.get('response', {})
+            status = entry_response.get('status', '')
+            if status.startswith('2'):
+                succeeded.append(entry)
+            else:
+                self._reject(entry, status, entry_response.get('outcome'))
+        return succeeded
+
+    def _reject(self, entry, status, outcome):
+        """Audit and tally an entry rejected by the server, retain if configured"""
+        audit_entry(f"response {status}: {outcome}", level="error")
+        audit_entry(f"bundle entry which generated errors: {entry}")
+        self.total_failed += 1
+        if self.rejects is not None:
+            self.rejects.write(entry, status, outcome)
+
+    def _tune(self, entries, latency, payload_bytes):
+        """Adjust bundle size, given measures of a successful transaction"""
+        size = self.batch_size
+        if self.target_latency and latency > self.target_latency:
+            size = int(size * self.target_latency / latency)
+        elif not self.target_latency or latency < self.target_latency / 2:
+            # grow gradually, at least one entry at a time
+            size += max(1, size // 4)
+
+        if self.max_bundle_bytes and payload_bytes:
+            size = min(size, int(self.max_bundle_bytes * entries / payload_bytes))
+
+        self.batch_size = min(self.max_batch_size, max(self.min_batch_size, size))
@@ -0,0 +1,94 @@
+"""Local state files, such as the checkpoint of an upload in progress"""
+import json
+import os
+import tempfile
+
+
+def read_json(path):
+    """Return data from JSON file at path, None if not found"""
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return None
+
+
+def write_json_atomic(path, data):
+    """Write data as JSON to path, replacing any previous file atomically
+
+    Written to a temporary file in the same directory, then renamed over
+    path, so readers never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.hydrant-', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(data, tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class UploadCheckpoint(object):
+    """Progress of an upload, saved after each committed Bundle
+
+    Records the count of Bundles committed and of input rows fully
+    processed (all resulting resources committed), so an interrupted
+    upload may resume after the last committed row.
+    """
+
+    def __init__(self, path, filename):
+        """Initialize checkpoint
+
+        :param path: path to the checkpoint (state) file
+        :param filename: input file being uploaded; stdin isn't supported,
+          as it can't be identified to safely resume
+        """
+        if filename == '-':
+            raise ValueError("checkpoints require a named input file, not stdin")
+        self.path = path
+        self.filename = filename
+        self.bundles = 0
+        self.rows = 0
+
+    def source(self):
+        """Identify the input, such that a changed file isn't resumed"""
+        stat = os.stat(self.filename)
+        return {
+            'filename': os.path.abspath(self.filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+        }
+
+    def load(self):
+        """Load previously saved progress, returning count of rows committed
+
+        :raises ValueError: if the checkpoint was saved for another input
+        """
+        state = read_json(self.path)
+        if state is None:
+            return 0
+        if state['source'] != self.source():
+            raise ValueError(
+                f"checkpoint {self.path} doesn't match {self.filename}, "
+                "input changed since saved")
+        self.bundles = state['bundles']
+        self.rows = state['rows']
+        return self.rows
+
+    def save(self, bundles, rows):
+        """Record progress, given totals committed"""
+        self.bundles = bundles
+        self.rows = rows
+        write_json_atomic(
+            self.path, {'source': self.source(), 'bundles': bundles, 'rows': rows})
+
+    def clear(self):
+        """Remove checkpoint, once upload is complete"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,9 +1,60 @@
-from datetime import datetime
+from datetime import datetime, time
+from functools import lru_cache
+import re
 from flask import current_app
 from dateutil import parser
 
 WRAP_YEAR = 2022
 
+# As we use datetime.strftime for display, and it can't handle dates
+# older than 1900, treat all such dates as an error
+EPOCH = datetime(year=1900, month=1, day=1)
+MIDNIGHT = time()
+
+# Common site formats, parsed without dateutil: `MM/DD/YYYY` (or `-`
+# separated, or two digit year) and ISO `YYYY-MM-DD`
+MONTH_DAY_YEAR = re.compile(r'(\d{1,2})([/-])(\d{1,2})\2(\d{4}|\d{2})')
+ISO_DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
+# Mirror dateutil's treatment of two digit years: within 50 years of now
+_THIS_YEAR = datetime.now().year
+_THIS_CENTURY = _THIS_YEAR // 100 * 100
+
+
+def _two_digit_year(year):
+    year += _THIS_CENTURY
+    if year >= _THIS_YEAR + 50:
+        year -= 100
+    elif year < _THIS_YEAR - 50:
+        year += 100
+    return year
+
+
+def _fast_parse(data):
+    """Parse common date only formats, None if not applicable"""
+    match = MONTH_DAY_YEAR.fullmatch(data)
+    if match:
+        month, _, day, year = match.groups()
+        year = int(year) if len(year) == 4 else _two_digit_year(int(year))
+        month, day = int(month), int(day)
+    else:
+        match = ISO_DATE.fullmatch(data)
+        if not match:
+            return
+        year, month, day = (int(i) for i in match.groups())
+
+    try:
+        return datetime(year=year, month=month, day=day)
+    except ValueError:
+        # i.e. day first values - leave to dateutil
+        return
+
+
+@lru_cache(maxsize=8192)
+def _parse_string(data):
+    """Parse string, memoized as the same values repeat across rows"""
+    return _fast_parse(data) or parser.parse(data)
+
 
 def parse_datetime(data, error_subject=None, none_safe=False):
     """Parse input string to generate a UTC datetime instance
@@ -27,12 +78,20 @@ def parse_datetime(data, error_subject=None, none_safe=False):
         return None
 
     try:
-        dt = parser.parse(data)
+        if isinstance(data, str):
+            dt = _parse_string(data)
+        else:
+            dt = parser.parse(data)
     except (TypeError, ValueError) as e:
         msg = "Unable to parse {}: {}".format(error_subject, e)
         current_app.logger.warning(msg)
         raise ValueError(msg)
 
+    return _normalize(dt)
+
+
+def _normalize(dt):
+    """Apply UTC, pre-1900 and WRAP_YEAR rules to a parsed datetime"""
     if dt.tzinfo:
         # Convert to UTC if necessary
         if dt.tzinfo != "UTC":
@@ -42,10 +101,7 @@ def parse_datetime(data, error_subject=None, none_safe=False):
         # UTC, and timezone unaware.
         dt = dt.replace(tzinfo=None)
 
-    # As we use datetime.strftime for display, and it can't handle dates
-    # older than 1900, treat all such dates as an error
-    epoch = datetime.strptime('1900-01-01', '%Y-%m-%d')
-    if dt < epoch:
+    if dt < EPOCH:
         raise ValueError("Dates prior to year 1900 not supported")
 
     # Correct for python's inappropriate WRAP_YEAR of '69
@@ -53,3 +109,22 @@ def parse_datetime(data, error_subject=None, none_safe=False):
         dt = dt.replace(year=dt.year-100)
 
     return dt
+
+
+def normalize_date_string(data):
+    """Rewrite a date string in ISO (YYYY-MM-DD) form, for bulk normalization
+
+    `parse_datetime()` of the result matches that of the given value,
+    and takes the fast path.  Values including a time of day or zone,
+    or that can't be parsed, are returned unchanged (without logging),
+    leaving any error to be reported when the value is used.  Years are
+    not wrapped here, `parse_datetime()` alone applies WRAP_YEAR.
+    """
+    try:
+        dt = _parse_string(data)
+    except (TypeError, ValueError):
+        return data
+
+    if dt.tzinfo is not None or dt.time() != MIDNIGHT:
+        return data
+    return dt.date().isoformat()
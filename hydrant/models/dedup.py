@@ -0,0 +1,89 @@
+"""Stores for the unique keys seen while generating a ResourceList
+
+Each store implements `add(key)`, returning False if the key was
+previously added, and `close()` to release any resources held.
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+
+
+def key_digest(key):
+    """Fixed size digest of a unique key (tuple of simple values)"""
+    return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+
+
+class MemoryKeyStore(object):
+    """Retain keys seen in an in memory set"""
+
+    def __init__(self):
+        self._keys = set()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        """Add key, returning False if previously added"""
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        return True
+
+    def close(self):
+        self._keys = set()
+
+
+class SqliteKeyStore(object):
+    """Retain digests of keys seen in an on disk sqlite database
+
+    For files with too many unique rows to dedup in memory.  Unless a
+    `path` is given, a temporary database is used and removed on close.
+    A given database must not already hold a store, as keys seen by
+    another run would be mistaken for duplicates.
+    """
+    COMMIT_INTERVAL = 10000
+
+    def __init__(self, path=None):
+        self._tempfile = None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='hydrant-dedup-', suffix='.sqlite')
+            os.close(fd)
+            self._tempfile = path
+        self._con = sqlite3.connect(path)
+        # throw away store, durability not needed
+        self._con.execute("PRAGMA journal_mode = OFF")
+        self._con.execute("PRAGMA synchronous = OFF")
+        try:
+            self._con.execute(
+                "CREATE TABLE keys_seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+        except sqlite3.OperationalError:
+            self.close()
+            raise ValueError(f"{path} already holds a dedup key store")
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, key):
+        """Add key, returning False if previously added"""
+        cursor = self._con.execute(
+            "INSERT OR IGNORE INTO keys_seen (digest) VALUES (?)", (key_digest(key),))
+        if cursor.rowcount != 1:
+            return False
+        self._count += 1
+        if self._count % self.COMMIT_INTERVAL == 0:
+            self._con.commit()
+        return True
+
+    def close(self):
+        self._con.close()
+        if self._tempfile:
+            os.remove(self._tempfile)
+            self._tempfile = None
+
+
+KEY_STORES = {
+    'memory': MemoryKeyStore,
+    'sqlite': SqliteKeyStore,
+}
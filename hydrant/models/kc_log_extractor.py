@@ -1,19 +1,75 @@
 """Module to encapsulate extracting KeyCloak event log data"""
+import atexit
+from contextlib import contextmanager
 import datetime
 from flask import current_app
+import gzip
+import io
 import json
-import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+import threading
 
+from hydrant.models.checkpoint import read_json, write_json_atomic
 
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the shared DB connection pool, built on first use
+
+    Configured from the DB_* settings; each connection applies the
+    DB_STATEMENT_TIMEOUT (milliseconds, 0 for none) to every statement.
+    The pool is closed at interpreter exit, see `close_pool()`.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(
+                minconn=current_app.config.get("DB_POOL_MIN"),
+                maxconn=current_app.config.get("DB_POOL_MAX"),
+                dbname=current_app.config.get("DB_DATABASE"),
+                user=current_app.config.get("DB_USER"),
+                password=current_app.config.get("DB_PASSWORD"),
+                host=current_app.config.get("DB_ADDR"),
+                port=current_app.config.get("DB_PORT"),
+                options=f"-c statement_timeout={current_app.config.get('DB_STATEMENT_TIMEOUT')}",
+            )
+    return _pool
+
+
+def close_pool():
+    """Close all connections of the shared pool, if built"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            if not _pool.closed:
+                _pool.closeall()
+            _pool = None
+
+
+atexit.register(close_pool)
+
+
+@contextmanager
 def get_con():
-    """Return live DB connection"""
-    return psycopg2.connect(
-        dbname=current_app.config.get("DB_DATABASE"),
-        user=current_app.config.get("DB_USER"),
-        password=current_app.config.get("DB_PASSWORD"),
-        host=current_app.config.get("DB_ADDR"),
-        port=current_app.config.get("DB_PORT")
-    )
+    """Check out a live DB connection from the pool, for use in a `with` block
+
+    The transaction is committed on leaving the block, or rolled back on
+    error; either way the connection is returned to the pool (discarded
+    if broken).
+    """
+    pool = get_pool()
+    db_con = pool.getconn()
+    try:
+        yield db_con
+        db_con.commit()
+    except Exception:
+        if not db_con.closed:
+            db_con.rollback()
+        raise
+    finally:
+        pool.putconn(db_con, close=bool(db_con.closed))
 
 
 def get_count(db_con):
@@ -23,37 +79,94 @@ def get_count(db_con):
     return row[0]
 
 
-def user_id_name_map(db_con):
-    """Only login events include username - capture mapping"""
-    user_ids = []
-    with db_con.cursor() as cursor:
-        cursor.execute(
-            "SELECT DISTINCT(user_id) FROM event_entity")
-        for row in cursor:
-            if not row[0]:
-                continue
-            user_ids.append(row[0])
+class EventMark(object):
+    """High-water mark of events extracted, for incremental extraction
+
+    Position is the greatest (event_time, id) of the events extracted,
+    the id breaking ties between events logged the same millisecond.
+    Persisted in a local state file, only once saved (i.e. after events
+    up to the mark were successfully written), such that a failed run
+    is repeated in full next time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        state = read_json(path)
+        self.position = (state['event_time'], state['id']) if state else None
+        self._saved = self.position
+
+    def observe(self, event_time, event_id):
+        """Advance mark given an event extracted"""
+        if self.position is None or (event_time, event_id) > self.position:
+            self.position = (event_time, event_id)
 
+    def save(self):
+        """Persist mark, replacing any previous atomically"""
+        if self.position == self._saved:
+            return
+        event_time, event_id = self.position
+        write_json_atomic(self.path, {'event_time': event_time, 'id': event_id})
+        self._saved = self.position
+
+
+def user_id_name_map(db_con, since=None):
+    """Only login events include username - capture mapping
+
+    One query for all users, taking the username from each user's most
+    recent login event.
+
+    :param since: (event_time, id) position; if given, only users with
+      events following are mapped
+    """
+    query = (
+        "SELECT DISTINCT ON (user_id) user_id, details_json FROM event_entity"
+        " WHERE type = %s AND user_id IS NOT NULL")
+    params = ['LOGIN']
+    if since:
+        query += (
+            " AND user_id IN (SELECT user_id FROM event_entity"
+            " WHERE (event_time, id) > (%s, %s))")
+        params.extend(since)
     map = {}
     with db_con.cursor() as cursor:
-        for user_id in user_ids:
-            cursor.execute(
-                "SELECT details_json FROM event_entity "
-                f" WHERE type = 'LOGIN' AND user_id = '{user_id}' LIMIT 1")
-            row = cursor.fetchone()
-            if row:
-                map[user_id] = json.loads(row[0]).get("username", "")
+        cursor.execute(query + " ORDER BY user_id, event_time DESC", params)
+        for user_id, details_json in cursor:
+            if not user_id:
+                continue
+            map[user_id] = json.loads(details_json or '{}').get("username", "")
 
     return map
 
 
-def get_events(db_con):
-    user_name_map = user_id_name_map(db_con)
-    with db_con.cursor() as cursor:
-        cursor.execute(
-            "SELECT user_id, session_id, event_time, type, details_json "
-            " FROM event_entity")
+def get_events(db_con, itersize=2000, mark=None):
+    """Generate each event, as a dictionary
+
+    Rows are fetched via a named (server side) cursor, `itersize` rows
+    at a time, so memory use doesn't grow with the size of the table.
+
+    :param mark: EventMark; if given, only events following its position
+      are generated, and the mark advanced with each.  Call `mark.save()`
+      once the events generated are safely stored.
+
+    Should consumption stop early, close the generator (closing the
+    cursor) before `db_con` is released, i.e. with `contextlib.closing`.
+    """
+    since = mark.position if mark else None
+    user_name_map = user_id_name_map(db_con, since=since)
+    query = (
+        "SELECT user_id, session_id, event_time, type, details_json, id "
+        " FROM event_entity")
+    params = None
+    if since:
+        # row comparison, satisfied by an index on (event_time, id)
+        query += " WHERE (event_time, id) > (%s, %s)"
+        params = since
+    with db_con.cursor(name='kc_events') as cursor:
+        cursor.itersize = itersize
+        cursor.execute(query, params)
         for row in cursor:
+            if mark:
+                mark.observe(row[2], row[5])
             yield {
                 "user_id": row[0],
                 "user_name": user_name_map.get(row[0], ""),
@@ -64,10 +177,42 @@ def get_events(db_con):
             }
 
 
-def dump_events():
-    con = get_con()
-    results = []
-    for event in get_events(con):
-        results.append(event)
+def write_events(events, buffer, ndjson=False, compress=False):
+    """Write events to buffer as generated, returning count written
+
+    :param events: iterable of events, see `get_events()`
+    :param buffer: text buffer to receive data, or binary buffer if
+      `compress` is set
+    :param ndjson: set true to write one event per line (NDJSON), by
+      default events are written as an (indented) JSON array
+    :param compress: set true to gzip output
+    """
+    gzip_file = None
+    if compress:
+        gzip_file = gzip.GzipFile(fileobj=buffer, mode='wb')
+        buffer = io.TextIOWrapper(gzip_file, encoding='utf-8')
+
+    count = 0
+    for event in events:
+        if ndjson:
+            buffer.write(json.dumps(event))
+            buffer.write('\n')
+        else:
+            # match json.dumps(list(events), indent=2), one event at a time
+            buffer.write(',\n' if count else '[\n')
+            buffer.write('\n'.join(
+                '  ' + line for line in json.dumps(event, indent=2).splitlines()))
+        count += 1
+    if not ndjson:
+        buffer.write('\n]\n' if count else '[]\n')
 
-    return results
+    buffer.flush()
+    if gzip_file:
+        # closes the gzip stream, leaving the given buffer open
+        buffer.close()
+    return count
+
+
+def dump_events():
+    with get_con() as con:
+        return list(get_events(con))
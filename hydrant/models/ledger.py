@@ -0,0 +1,64 @@
+"""Ledger of resources previously uploaded, for incremental (delta) uploads
+
+Sites resend cumulative extracts; the ledger retains a digest of each
+resource (keyed by target system and conditional update `search_url`)
+as of its last successful upload, so unchanged resources may be skipped.
+"""
+import hashlib
+import json
+import sqlite3
+
+
+def entry_digest(entry):
+    """Fixed size digest of the resource in an upsert (bundle) entry"""
+    payload = json.dumps(entry['resource'], sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+
+class UploadLedger(object):
+    """Digests of uploaded resources, retained in an sqlite database
+
+    Entries are only recorded once the bundle containing them was
+    accepted by the FHIR server, see `record()`.
+    """
+
+    def __init__(self, path, target_system):
+        self.target_system = target_system
+        self._con = sqlite3.connect(path)
+        self._con.execute("PRAGMA journal_mode = WAL")
+        self._con.execute(
+            "CREATE TABLE IF NOT EXISTS uploaded ("
+            " system TEXT NOT NULL,"
+            " search_url TEXT NOT NULL,"
+            " digest BLOB NOT NULL,"
+            " PRIMARY KEY (system, search_url)) WITHOUT ROWID")
+        self._con.commit()
+
+    def __len__(self):
+        return self._con.execute(
+            "SELECT COUNT(*) FROM uploaded WHERE system = ?",
+            (self.target_system,)).fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def unchanged(self, entry):
+        """Return True if entry matches that recorded at last upload"""
+        row = self._con.execute(
+            "SELECT digest FROM uploaded WHERE system = ? AND search_url = ?",
+            (self.target_system, entry['request']['url'])).fetchone()
+        return row is not None and row[0] == entry_digest(entry)
+
+    def record(self, entries):
+        """Record entries of a successfully uploaded bundle"""
+        self._con.executemany(
+            "INSERT OR REPLACE INTO uploaded (system, search_url, digest) VALUES (?, ?, ?)",
+            ((self.target_system, entry['request']['url'], entry_digest(entry))
+             for entry in entries))
+        self._con.commit()
+
+    def close(self):
+        self._con.close()
@@ -1,7 +1,140 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from urllib.parse import quote, urlencode
 
+from hydrant import fhir_client
+from hydrant.models.bundle import Bundle
 from hydrant.models.resource import Resource
 
+# Cache in effect for the current upload run, see `patient_cache()`
+_active_cache = None
+
+
+class PatientCache(object):
+    """Bounded LRU cache of Patient ids keyed on (family, given, birthDate)
+
+    Dependent resources (i.e. ServiceRequest, DocumentReference) must look
+    up the referenced Patient, and site files often repeat the same patient
+    on many rows.  Cache each id found to avoid repeating the round trip.
+    """
+
+    def __init__(self, maxsize=10000, cache_misses=False):
+        """Initialize empty cache
+
+        :param maxsize: maximum number of keys retained; least recently
+          used keys are evicted beyond this bound
+        :param cache_misses: set true to also cache failed lookups
+          (negative caching), i.e. patients not found on the FHIR server
+        """
+        self.maxsize = maxsize
+        self.cache_misses = cache_misses
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @staticmethod
+    def key(name, birthDate):
+        """Generate cache key from patient demographics"""
+        given = name.get('given') or [None]
+        return name.get('family'), given[0], birthDate
+
+    def get(self, key):
+        """Return cached id for key, marking it most recently used
+
+        :raises KeyError: if key is not cached
+        """
+        try:
+            patient_id = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return patient_id
+
+    def set(self, key, patient_id):
+        """Cache id for key; None values only retained with `cache_misses`"""
+        if patient_id is None and not self.cache_misses:
+            return
+        self._entries[key] = patient_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def prefetch(self, patients, target_system, batch_size=100):
+        """Resolve ids for given patients with batched FHIR searches
+
+        Rather than a round trip per patient, bundle up to `batch_size`
+        search requests in each FHIR `batch` Bundle and cache the results.
+        Patients already cached are not requested again.
+
+        :param patients: iterable of Patient instances to resolve
+        :param target_system: FHIR server base URL
+        :param batch_size: maximum search requests per batch Bundle
+        :returns: number of patients requested
+        """
+        requested, pending = 0, []
+        for patient in patients:
+            if patient.cache_key() in self:
+                continue
+            pending.append(patient)
+            if len(pending) >= batch_size:
+                requested += self._resolve(pending, target_system)
+                pending = []
+        if pending:
+            requested += self._resolve(pending, target_system)
+        return requested
+
+    def _resolve(self, patients, target_system):
+        """Send a batch of patient searches, caching the ids found
+
+        Without a target system, as with `Resource.id()`, no lookup is made.
+        """
+        if not target_system:
+            return 0
+        bundle = Bundle(bundle_type='batch')
+        for patient in patients:
+            bundle.add_entry({'request': {'method': 'GET', 'url': patient.search_url()}})
+
+        headers = {'Cache-Control': 'no-cache'}
+        response = fhir_client.post(target_system, json=bundle.as_fhir(), headers=headers)
+        response.raise_for_status()
+
+        # batch-response entries are returned in the order requested
+        for patient, entry in zip(patients, response.json().get('entry', [])):
+            if not entry.get('response', {}).get('status', '').startswith('2'):
+                # leave failures for the individual lookup to report
+                continue
+            try:
+                patient_id = patient.id_from_searchset(entry['resource'])
+            except RuntimeError:
+                # multiple matches; individual lookup raises in context
+                continue
+            self.set(patient.cache_key(), patient_id)
+        return len(patients)
+
+
+@contextmanager
+def patient_cache(maxsize=10000, cache_misses=False):
+    """Context manager scoping a shared PatientCache, i.e. to an upload run
+
+    All `Patient.id()` lookups within the context consult and populate
+    the same cache.  Yields the active cache.
+    """
+    global _active_cache
+    previous = _active_cache
+    _active_cache = PatientCache(maxsize=maxsize, cache_misses=cache_misses)
+    try:
+        yield _active_cache
+    finally:
+        _active_cache = previous
+
 
 class Patient(Resource):
     """Minimal FHIR like Patient for parsing / uploading """
@@ -14,6 +147,23 @@ class Patient(Resource):
         if birthDate:
             self._fields['birthDate'] = birthDate
 
+    def cache_key(self):
+        """Key for this patient in a PatientCache"""
+        return PatientCache.key(
+            self._fields.get('name', {}), self._fields.get('birthDate'))
+
+    def id(self):
+        """Look up FHIR id, consulting the active PatientCache if any"""
+        if self._id is not None or _active_cache is None:
+            return super().id()
+
+        key = self.cache_key()
+        try:
+            self._id = _active_cache.get(key)
+        except KeyError:
+            _active_cache.set(key, super().id())
+        return self._id
+
     def search_url(self):
         """Generate the request path search url for Patient
 
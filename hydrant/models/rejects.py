@@ -0,0 +1,54 @@
+"""Quarantine of bundle entries rejected by the FHIR server"""
+import json
+
+
+def response_outcome(response):
+    """OperationOutcome from an error response, or None if not given"""
+    try:
+        outcome = response.json()
+    except ValueError:
+        return None
+    if not isinstance(outcome, dict) or outcome.get('resourceType') != 'OperationOutcome':
+        return None
+    return outcome
+
+
+class RejectFile(object):
+    """Write rejected bundle entries, one JSON object per line (NDJSON)
+
+    Each line holds the `status` returned, the entry `request` and
+    `resource`, and the OperationOutcome explaining the rejection (if
+    any) as `outcome`.
+    """
+
+    def __init__(self, path, append=False):
+        """Open reject file
+
+        :param path: path to the reject file
+        :param append: set to add to an existing file, i.e. when resuming
+          an upload, otherwise any existing file is truncated
+        """
+        self.path = path
+        self.total = 0
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, entry, status, outcome=None):
+        record = {
+            'status': status,
+            'request': entry.get('request'),
+            'resource': entry.get('resource'),
+            'outcome': outcome,
+        }
+        self._file.write(json.dumps(record, separators=(',', ':')))
+        self._file.write('\n')
+        self._file.flush()
+        self.total += 1
+
+    def close(self):
+        self._file.close()
@@ -1,6 +1,6 @@
 from collections import OrderedDict
-import requests
 
+from hydrant import fhir_client
 from hydrant.config import FHIR_SERVER_URL
 
 
@@ -25,18 +25,26 @@ class Resource(object):
         # Round-trip to see if this represents a new or existing resource
         if FHIR_SERVER_URL:
             headers = {'Cache-Control': 'no-cache'}
-            response = requests.get('/'.join((FHIR_SERVER_URL, self.search_url())), headers=headers)
+            response = fhir_client.get('/'.join((FHIR_SERVER_URL, self.search_url())), headers=headers)
             response.raise_for_status()
 
-            # extract Resource.id from bundle
-            bundle = response.json()
-            if bundle['total']:
-                if bundle['total'] > 1:
-                    raise RuntimeError(
-                        "Found multiple matches, can't generate upsert"
-                        f"for {self.search_url()}")
-                assert bundle['entry'][0]['resource']['resourceType'] == self.RESOURCE_TYPE
-                self._id = bundle['entry'][0]['resource']['id']
+            self.id_from_searchset(response.json())
+        return self._id
+
+    def id_from_searchset(self, bundle):
+        """Extract and retain Resource.id from the results of search_url()
+
+        :param bundle: searchset Bundle returned from the search_url() query
+        :returns: the id found, or None if the search had no match
+        :raises RuntimeError: if the search matched multiple resources
+        """
+        if bundle['total']:
+            if bundle['total'] > 1:
+                raise RuntimeError(
+                    "Found multiple matches, can't generate upsert"
+                    f"for {self.search_url()}")
+            assert bundle['entry'][0]['resource']['resourceType'] == self.RESOURCE_TYPE
+            self._id = bundle['entry'][0]['resource']['id']
         return self._id
 
     def as_fhir(self):
@@ -74,8 +82,17 @@ class Resource(object):
         """
 
         # Use given adapter to parse "row" data
-        adapter = adapter_cls(data)
+        return cls.from_adapter(adapter_cls(data))
 
+    @classmethod
+    def from_adapter(cls, adapter):
+        """Populate resource fields from an adapter instance
+
+        :param adapter: adapter instance, wrapping a single `row` of data,
+          with accessor methods to obtain resource attributes
+
+        :returns: populated resource instance, from adapter data
+        """
         # Populate instance with available data from adapter / row
         resource = cls()
         for key, value in adapter.items():
@@ -1,31 +1,161 @@
+from collections import deque
+from itertools import islice
 import logging
+import multiprocessing
+
+from hydrant import fhir_client
+from hydrant.models.dedup import MemoryKeyStore
+from hydrant.models.patient import Patient
+
+
+def chunked(iterable, size):
+    """Generate lists of up to `size` consecutive items from iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def transform_rows(adapter_cls, rows):
+    """Adapt each row, returning list of (unique key, resource) pairs
+
+    Module level (picklable) for use by pool worker processes.  Key is
+    None for adapters not sorting out duplicates, see unique_key().
+    """
+    results = []
+    for row in rows:
+        adapter = adapter_cls(row)
+        results.append((adapter.unique_key(), adapter_cls.RESOURCE_CLASS.from_adapter(adapter)))
+    return results
 
 
 class ResourceList(object):
     """Generates unique FHIR Resources from given parser / adapter"""
 
-    def __init__(self, parser, adapter):
+    def __init__(
+            self, parser, adapter, key_store=MemoryKeyStore, processes=1,
+            chunk_size=500, start_row=0):
+        """Initialize list
+
+        :param parser: parser instance, providing `rows()`
+        :param adapter: adapter class, instantiated on each row
+        :param key_store: class (or callable) generating the store used
+          to retain unique keys seen, see `hydrant.models.dedup`
+        :param processes: number of worker processes transforming rows;
+          1 to transform in the current process
+        :param chunk_size: rows sent to a worker process at a time
+        :param start_row: count of leading rows to skip, i.e. those
+          committed before an upload was interrupted.  NB - keys of
+          skipped rows aren't seen, so later duplicates aren't skipped
+        """
         self.parser = parser
         self.adapter = adapter
+        self.key_store = key_store
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.start_row = start_row
+        # count of rows read, through that generating the last resource
+        self.rows_read = start_row
         self.item_count = 0
         self._iteration_complete = False
 
     def __iter__(self):
         """Use parser and adapter, yield each unique resource"""
-        keys_seen = set()
-        for row in self.parser.rows():
+        keys_seen = self.key_store()
+        self.rows_read = self.start_row
+        try:
+            if self.processes > 1:
+                yield from self._parallel_resources(keys_seen)
+            else:
+                yield from self._resources(keys_seen)
+        finally:
+            keys_seen.close()
+        self._iteration_complete = True
+
+    def rows(self):
+        """Generate parsed rows, less any skipped by `start_row`"""
+        return islice(self.parser.rows(), self.start_row, None)
+
+    def _unique(self, keys_seen, key):
+        """Record key, returning False if a previous entry matched"""
+        if key is None:
+            return True
+        if not keys_seen.add(key):
+            logging.info(f"skipping duplicate: {key}")
+            return False
+        return True
+
+    def _resources(self, keys_seen):
+        for row in self.rows():
+            self.rows_read += 1
+            # One adapter instance per row, shared by unique_key() and
+            # resource generation, so derived attributes are only computed once
+            adapter = self.adapter(row)
+
             # Adapter may define unique_key() - if defined and a previous
             # entry matches, skip over this "duplicate"
-            if hasattr(self.adapter, 'unique_key'):
-                key = self.adapter(row).unique_key()
-                if key in keys_seen:
-                    logging.info("skipping duplicate: {key}")
-                    continue
-                keys_seen.add(key)
+            if not self._unique(keys_seen, adapter.unique_key()):
+                continue
 
             self.item_count += 1
-            yield self.adapter.RESOURCE_CLASS.factory(row, self.adapter)
-        self._iteration_complete = True
+            yield self.adapter.RESOURCE_CLASS.from_adapter(adapter)
+
+    def _parallel_resources(self, keys_seen):
+        """Transform chunks of rows in a pool of worker processes
+
+        Results are merged back in row order, so duplicates are skipped
+        exactly as when transformed in process.  NB - as duplicates are
+        only detected after transformation, they are transformed too.
+        Workers (when forked) inherit state such as an active PatientCache,
+        but not the FHIR session's connections.
+
+        At most two chunks per worker are outstanding, so the input is
+        only read as fast as resources are consumed (i.e. uploaded).
+        """
+        max_pending = 2 * self.processes
+        chunks = chunked(self.rows(), self.chunk_size)
+        pending = deque()
+        with multiprocessing.Pool(
+                processes=self.processes, initializer=fhir_client.reset_session) as pool:
+            while True:
+                for chunk in islice(chunks, max_pending - len(pending)):
+                    pending.append(pool.apply_async(transform_rows, (self.adapter, chunk)))
+                if not pending:
+                    break
+                results = pending.popleft().get()
+                for key, resource in results:
+                    self.rows_read += 1
+                    if not self._unique(keys_seen, key):
+                        continue
+                    self.item_count += 1
+                    yield resource
+
+    def referenced_patients(self):
+        """Yield each distinct Patient referenced by the parsed rows
+
+        Applicable to adapters defining a `subject`, i.e. those generating
+        resources dependent on an existing Patient.  Patients are built from
+        the row demographics only, no lookup is performed.
+        """
+        if not hasattr(self.adapter, 'subject'):
+            return
+
+        keys_seen = set()
+        for row in self.rows():
+            adapter = self.adapter(row)
+            if not adapter.birthDate:
+                # incomplete demographics; left for the row to report
+                continue
+            patient = Patient(name=adapter.name, birthDate=adapter.birthDate)
+            key = patient.cache_key()
+            if key in keys_seen:
+                continue
+            keys_seen.add(key)
+            yield patient
 
     def __len__(self):
         """Return length (count) of unique resources discovered in generator
@@ -1,13 +1,11 @@
 import click
+from contextlib import closing
 from flask import Blueprint, abort, current_app, jsonify
 from flask.json import JSONEncoder
-import jmespath
-from json import JSONDecodeError
-import importlib
-import requests
 import sys
 
-from hydrant.models.bundle import BatchUpload
+from hydrant.models.bundle import BatchUpload, SearchError, SearchsetPages
+from hydrant.models.dedup import KEY_STORES
 
 base_blueprint = Blueprint('base', __name__, cli_group=None)
 
@@ -51,136 +49,295 @@ def config_settings(config_key):
 @base_blueprint.cli.command("export")
 @click.argument("adapter")
 @click.option("--filter", help="HAPI FHIR filter parameters")
-def export(adapter, filter):
+@click.option("--count", type=int, help="Resources per page (`_count` search parameter)")
+@click.option(
+    "--read-ahead", type=int,
+    help="Pages requested ahead of serialization, overrides EXPORT_READ_AHEAD")
+@click.option("--gzip", "compress", is_flag=True, help="Write gzip compressed output")
+def export(adapter, filter, count, read_ahead, compress):
     """Export data using the named adapter
 
     Named adapter knows how to connect to data source and format for export
     """
     from hydrant.adapters.csv import CSV_Serializer
+    from hydrant.adapters.factory import adapter_by_name
 
-    # attempt to load adapter class from configured modules
-    m1 = importlib.import_module('hydrant.adapters.sites.kent')
-    m2 = importlib.import_module('hydrant.adapters.sites.skagit')
-    adapter_class = None
-    for module in m1, m2:
-        if hasattr(module, adapter):
-            adapter_class = getattr(module, adapter)
-
+    # attempt to load adapter class from registered site adapters
+    adapter_class = adapter_by_name(adapter)
     if not adapter_class:
         raise click.BadParameter(f"Adapter class not found: {adapter}")
 
     # Pull resources from backing store and generate export via adapter class
     target_system = current_app.config['FHIR_SERVER_URL']
     search_url = '/'.join((target_system, adapter_class.RESOURCE_CLASS.RESOURCE_TYPE))
-    if filter:
-        search_url = '?'.join((search_url, filter))
-    response = requests.get(search_url)
-    try:
-        bundle = response.json()
-    except JSONDecodeError:
-        raise click.UsageError(f"{response.status_code} FROM {search_url} - {response.text}")
-
-    assert bundle['resourceType'] == 'Bundle'
-    serializer = CSV_Serializer(sys.stdout)
+    search_params = [p for p in (filter, count and f"_count={count}") if p]
+    if search_params:
+        search_url = '?'.join((search_url, '&'.join(search_params)))
+
+    serializer = CSV_Serializer(
+        sys.stdout.buffer if compress else sys.stdout,
+        flush_rows=current_app.config['EXPORT_FLUSH_ROWS'],
+        flush_bytes=current_app.config['EXPORT_FLUSH_BYTES'],
+        compress=compress)
     serializer.headers(adapter_class.headers())
 
-    # Bundle will potentially include pages of results
+    # Search results potentially span many pages (bundles), requested
+    # ahead of time while the current page is serialized
+    if read_ahead is None:
+        read_ahead = current_app.config['EXPORT_READ_AHEAD']
+    pages = SearchsetPages(
+        search_url=search_url, target_system=target_system, read_ahead=read_ahead)
     total = 0
-    while True:
-        if 'entry' not in bundle:
-            break
-
-        for entry in bundle['entry']:
-            item = adapter_class(parsed_row=None)
-            serializer.add_row(item.from_resource(entry['resource']))
-            total += 1
-        serializer.flush()
-        next_page_link = jmespath.search('link[?relation==`next`].{url: url}', bundle)
-        if not next_page_link:
-            break
-
-        # HAPI server config uses a `dashboard` protected URL, which we can't write to.
-        #   see: https://github.com/uwcirg/cosri-environments/pull/56
-        # correct server portion of `next` to configured `FHIR_SERVER_URL`,
-        # relying on `/fhir` request path in both
-        expected_request_path_base = '/fhir'
-        assert target_system.endswith(expected_request_path_base)
-        if next_page_link[0]['url'].count(expected_request_path_base) != 1:
-            raise ValueError(
-                f"missing expected request path {expected_request_path_base} "
-                f"in next page url {next_page_link[0]['url']}")
-
-        _, requestpath = next_page_link[0]['url'].split(expected_request_path_base)
-        next_url = target_system + requestpath
-
-        try:
-            response = requests.get(next_url)
-            bundle = response.json()
-        except JSONDecodeError:
-            raise click.UsageError(f"{response.status_code} FROM {next_url} - {response.text}")
+    try:
+        for bundle in pages:
+            assert bundle['resourceType'] == 'Bundle'
+            if 'entry' not in bundle:
+                break
+
+            for entry in bundle['entry']:
+                item = adapter_class(parsed_row=None)
+                serializer.add_row(item.from_resource(entry['resource']))
+                total += 1
+            serializer.flush()
+    except SearchError as error:
+        raise click.UsageError(str(error))
+    finally:
+        serializer.close()
 
     # Write to stderr so as to not pollute output file
     click.echo(f"Exported {total} {adapter_class.RESOURCE_CLASS.RESOURCE_TYPE}s", err=True)
 
 
 @base_blueprint.cli.command("upload")
-@click.argument("filename")
-def upload_file(filename):
+@click.argument("filename", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option(
+    "--max-in-flight", type=int,
+    help="Bundles concurrently in flight, overrides UPLOAD_MAX_IN_FLIGHT")
+@click.option(
+    "--dedup-store", type=click.Choice(sorted(KEY_STORES)),
+    help="Store for unique keys seen, overrides UPLOAD_DEDUP_STORE")
+@click.option(
+    "--processes", type=int,
+    help="Worker processes transforming rows, overrides UPLOAD_PROCESSES")
+@click.option(
+    "--columnar", is_flag=True, default=None,
+    help="Parse chunks of rows into columns, overrides UPLOAD_COLUMNAR")
+@click.option("--mmap", "use_mmap", is_flag=True, help="Read named file via mmap")
+@click.option("--ledger", help="Ledger of uploaded resources, overrides UPLOAD_LEDGER")
+@click.option(
+    "--force", is_flag=True,
+    help="Upload every resource, including those unchanged per the ledger")
+@click.option(
+    "--checkpoint", help="File saving upload progress, overrides UPLOAD_CHECKPOINT")
+@click.option(
+    "--resume", is_flag=True,
+    help="Skip rows committed before an interrupted upload, per the checkpoint")
+@click.option(
+    "--bundle-type", type=click.Choice(("transaction", "batch")),
+    help="Type of bundles uploaded, overrides UPLOAD_BUNDLE_TYPE")
+@click.option(
+    "--reject-file", help="NDJSON file of rejected entries, overrides UPLOAD_REJECT_FILE")
+def upload_file(
+        filename, max_in_flight, dedup_store, processes, columnar, use_mmap, ledger, force,
+        checkpoint, resume, bundle_type, reject_file):
     """Parse and upload content in named file
 
     Seek out given filename from configured upload directory.  Parse
-    the file, and push results to configured FHIR store.
+    the file, and push results to configured FHIR store.  Use `-` as
+    filename to read from stdin.
+
+    With a ledger configured, only resources new or changed since the
+    last upload are sent; use `--force` for a full resync.
+
+    With a checkpoint configured, progress is saved after each committed
+    bundle; should the upload fail, rerun with `--resume` to continue
+    after the last committed row.
+
+    With a reject file configured, entries failing a transaction are
+    isolated and written to the file, along with the server's
+    OperationOutcome, and the upload continues.  Batch bundles likewise
+    reject failing entries.
     """
-    try:
-        with open(filename, 'r') as f:
-            pass
-    except FileNotFoundError:
-        raise click.FileError(f"'{filename}'", "File not found")
 
     # Locate best parser and adapter
-    # TODO: move this process to factory methods
-    from hydrant.adapters.csv import CSV_Parser
-    from hydrant.adapters.sites.dawg import DawgPatientAdapter
-    from hydrant.adapters.sites.kent import KentPatientAdapter
-    from hydrant.adapters.sites.skagit import (
-        SkagitControlledSubstanceAgreementAdapter,
-        SkagitPatientAdapter,
-        SkagitServiceRequestAdapter,
-    )
+    from hydrant.adapters.factory import parser_and_adapter
+    from hydrant.models.checkpoint import UploadCheckpoint
+    from hydrant.models.ledger import UploadLedger
+    from hydrant.models.rejects import RejectFile
+    from hydrant.models.patient import patient_cache
     from hydrant.models.resource_list import ResourceList
 
-    adapter = None
-    parser = CSV_Parser(filename)
-    headers = set(parser.headers)
-
-    # sniff out the site adapter from the header values
-    for site_adapter in (
-            DawgPatientAdapter,
-            KentPatientAdapter,
-            SkagitPatientAdapter,
-            SkagitControlledSubstanceAgreementAdapter,
-            SkagitServiceRequestAdapter):
-        if not set(site_adapter.headers()).difference(headers):
-            if adapter:
-                raise click.BadParameter("column headers match multiple adapters")
-            adapter = site_adapter
-    if not adapter:
-        raise click.BadParameter("column headers not found in any available adapters")
+    if columnar is None:
+        columnar = current_app.config["UPLOAD_COLUMNAR"]
+    try:
+        parser, adapter = parser_and_adapter(
+            filename,
+            columnar=columnar,
+            chunk_size=current_app.config["UPLOAD_COLUMNAR_CHUNK_SIZE"],
+            use_mmap=use_mmap)
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+
+    checkpoint_path = checkpoint or current_app.config["UPLOAD_CHECKPOINT"]
+    if resume and not checkpoint_path:
+        raise click.UsageError("--resume requires a checkpoint, see --checkpoint")
+    if checkpoint_path and filename == '-':
+        # piped input can't be identified, nor its committed rows skipped safely
+        raise click.UsageError("checkpoints require a named file, not stdin")
+    upload_checkpoint = None
+    start_row = 0
+    if checkpoint_path:
+        upload_checkpoint = UploadCheckpoint(checkpoint_path, filename)
+        if resume:
+            try:
+                start_row = upload_checkpoint.load()
+            except ValueError as error:
+                raise click.UsageError(str(error))
+            click.echo(
+                f"  - resuming after {upload_checkpoint.bundles} bundles, {start_row} rows")
 
     # With parser and adapter at hand, process & upload the data
-    resources = ResourceList(parser, adapter)
-    batcher = BatchUpload(
-            target_system=current_app.config['FHIR_SERVER_URL'],
-            batch_size=current_app.config["UPLOAD_BUNDLE_SIZE"])
-    batcher.process(resources)
+    # sharing one patient lookup cache for the duration of the run
+    with patient_cache(
+            maxsize=current_app.config["PATIENT_CACHE_SIZE"],
+            cache_misses=current_app.config["PATIENT_CACHE_MISSES"]) as cache:
+        resources = ResourceList(
+            parser, adapter,
+            key_store=KEY_STORES[dedup_store or current_app.config["UPLOAD_DEDUP_STORE"]],
+            processes=processes or current_app.config["UPLOAD_PROCESSES"],
+            chunk_size=current_app.config["UPLOAD_CHUNK_SIZE"],
+            start_row=start_row)
+
+        # resolve patients referenced by dependent resources up front
+        # (requires a second pass over the input, not possible on a pipe)
+        prefetch_batch_size = current_app.config["PATIENT_PREFETCH_BATCH_SIZE"]
+        if (prefetch_batch_size and parser.seekable()
+                and current_app.config['FHIR_SERVER_URL']):
+            prefetched = cache.prefetch(
+                resources.referenced_patients(),
+                target_system=current_app.config['FHIR_SERVER_URL'],
+                batch_size=prefetch_batch_size)
+            if prefetched:
+                click.echo(f"  - prefetched {prefetched} patients")
+
+        reject_path = reject_file or current_app.config["UPLOAD_REJECT_FILE"]
+        rejects = RejectFile(reject_path, append=resume) if reject_path else None
+        ledger_path = ledger or current_app.config["UPLOAD_LEDGER"]
+        upload_ledger = None
+        if ledger_path:
+            upload_ledger = UploadLedger(
+                ledger_path, target_system=current_app.config['FHIR_SERVER_URL'])
+        batcher = BatchUpload(
+                target_system=current_app.config['FHIR_SERVER_URL'],
+                batch_size=current_app.config["UPLOAD_BUNDLE_SIZE"],
+                min_batch_size=current_app.config["UPLOAD_BUNDLE_SIZE_MIN"],
+                max_batch_size=current_app.config["UPLOAD_BUNDLE_SIZE_MAX"],
+                target_latency=current_app.config["UPLOAD_TARGET_LATENCY"],
+                max_bundle_bytes=current_app.config["UPLOAD_MAX_BUNDLE_BYTES"],
+                retries=current_app.config["FHIR_RETRIES"],
+                backoff_factor=current_app.config["FHIR_RETRY_BACKOFF"],
+                max_in_flight=max_in_flight or current_app.config["UPLOAD_MAX_IN_FLIGHT"],
+                ledger=upload_ledger,
+                force=force,
+                checkpoint=upload_checkpoint,
+                bundle_type=bundle_type or current_app.config["UPLOAD_BUNDLE_TYPE"],
+                rejects=rejects)
+        try:
+            batcher.process(resources)
+        finally:
+            if upload_ledger is not None:
+                upload_ledger.close()
+            if rejects is not None:
+                rejects.close()
+        if upload_checkpoint is not None:
+            upload_checkpoint.clear()
 
     click.echo(f"  - parsed {len(resources)}")
+    if upload_ledger is not None:
+        click.echo(f"  - unchanged {batcher.total_unchanged}")
     click.echo(f"  - uploaded {batcher.total_sent}")
+    if batcher.total_failed:
+        click.echo(f"  - failed {batcher.total_failed}")
+    if rejects is not None and rejects.total:
+        click.echo(f"  - rejected entries written to {reject_path}")
+    elif batcher.total_failed:
+        # failures only reported to the audit log, don't pass for success
+        raise click.ClickException(
+            f"{batcher.total_failed} entries failed to upload, see audit log; "
+            "set a reject file (--reject-file) to retain them")
     click.echo("upload complete")
 
 
 @base_blueprint.cli.command("kc_logs")
-def kc_logs():
-    import json
-    from hydrant.models.kc_log_extractor import dump_events
-    click.echo(json.dumps(dump_events(), indent=2))
+@click.option(
+    "--output", "-o", default="-", type=click.Path(dir_okay=False, allow_dash=True),
+    help="File to write events to, stdout by default")
+@click.option("--ndjson", is_flag=True, help="Write one event per line (NDJSON)")
+@click.option("--gzip", "compress", is_flag=True, help="Write gzip compressed output")
+@click.option(
+    "--incremental", is_flag=True,
+    help="Only extract events following those of the previous incremental run")
+@click.option(
+    "--state-file", help="File retaining the last event extracted, "
+    "overrides KC_EVENTS_STATE_FILE")
+@click.option(
+    "--ship", is_flag=True,
+    help="Send events to the configured LOGSERVER_URL, rather than write them out")
+def kc_logs(output, ndjson, compress, incremental, state_file, ship):
+    """Extract Keycloak event log
+
+    Events are streamed from the Keycloak database, and written out
+    as extracted, or with `--ship`, sent on to the log server in
+    batches.  With `--incremental`, the last event extracted is
+    retained in a state file once written (or shipped), and only newer
+    events are extracted on the next run.
+    """
+    from hydrant.logserverhandler import EventShipper, LogServerHandler
+    from hydrant.models.kc_log_extractor import (
+        EventMark,
+        get_con,
+        get_events,
+        write_events,
+    )
+
+    if ship and not current_app.config["LOGSERVER_URL"]:
+        raise click.UsageError("--ship requires a configured LOGSERVER_URL")
+
+    mark = None
+    if incremental:
+        state_file = state_file or current_app.config["KC_EVENTS_STATE_FILE"]
+        if not state_file:
+            raise click.UsageError("--incremental requires a state file, see --state-file")
+        mark = EventMark(state_file)
+
+    # events (and so the named cursor) closed before the connection is
+    # returned to the pool, even if writing or shipping fails
+    with get_con() as db_con, closing(get_events(
+            db_con, itersize=current_app.config["KC_EVENTS_ITERSIZE"], mark=mark)) as events:
+        if ship:
+            shipper = EventShipper(
+                LogServerHandler(
+                    url=current_app.config["LOGSERVER_URL"],
+                    jwt=current_app.config["LOGSERVER_TOKEN"],
+                    timeout=current_app.config["LOGSERVER_TIMEOUT"]),
+                batch_size=current_app.config["LOGSERVER_BATCH_SIZE"],
+                max_in_flight=current_app.config["LOGSERVER_MAX_IN_FLIGHT"],
+                retries=current_app.config["LOGSERVER_RETRIES"],
+                backoff_factor=current_app.config["FHIR_RETRY_BACKOFF"])
+            total = shipper.ship(events)
+            if shipper.failed:
+                raise click.ClickException(
+                    f"Shipped {total} events, failed to ship {shipper.failed} "
+                    f"to {current_app.config['LOGSERVER_URL']}")
+        elif output == '-':
+            total = write_events(
+                events, sys.stdout.buffer if compress else sys.stdout,
+                ndjson=ndjson, compress=compress)
+        else:
+            with open(output, 'wb' if compress else 'w') as output_file:
+                total = write_events(events, output_file, ndjson=ndjson, compress=compress)
+    if mark:
+        mark.save()
+
+    # Write to stderr so as to not pollute output
+    click.echo(f"{'Shipped' if ship else 'Extracted'} {total} events", err=True)
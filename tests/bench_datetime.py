@@ -0,0 +1,46 @@
+"""Benchmark parse_datetime against the prior dateutil only implementation
+
+Not collected by pytest; run directly:
+
+    PYTHONPATH=. python tests/bench_datetime.py
+"""
+from datetime import datetime
+import timeit
+
+from dateutil import parser
+
+from hydrant.models.datetime import WRAP_YEAR, _parse_string, parse_datetime
+
+# representative site values; distinct patients share many birth dates
+SAMPLES = [
+    '1/21/1950', '01-15-45', '11/28/1951', '1966-01-01', '07-22-20',
+    '12/31/1999', '2021-09-27', '3/4/1972', '01/15/1945', '10-07-20',
+]
+
+
+def dateutil_parse_datetime(data):
+    """Prior implementation of parse_datetime, for comparison"""
+    dt = parser.parse(data)
+    epoch = datetime.strptime('1900-01-01', '%Y-%m-%d')
+    if dt < epoch:
+        raise ValueError("Dates prior to year 1900 not supported")
+    if dt.year > WRAP_YEAR:
+        dt = dt.replace(year=dt.year-100)
+    return dt
+
+
+def run(label, func, number=5000):
+    elapsed = timeit.timeit(lambda: [func(s) for s in SAMPLES], number=number)
+    calls = number * len(SAMPLES)
+    print(f"{label:<32} {elapsed:7.3f}s  {elapsed / calls * 1e6:6.2f}us/call")
+
+
+if __name__ == '__main__':
+    assert [parse_datetime(s) for s in SAMPLES] == [dateutil_parse_datetime(s) for s in SAMPLES]
+    run("dateutil (prior)", dateutil_parse_datetime)
+    run("fast path, memoized", parse_datetime)
+
+    def uncached(data):
+        _parse_string.cache_clear()
+        return parse_datetime(data)
+    run("fast path, cache cleared", uncached)
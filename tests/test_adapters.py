@@ -1,10 +1,25 @@
+import csv
+from datetime import datetime
+import gzip
+import io
 import pytest
 import os
+import zipfile
 
-from hydrant.adapters.csv import CSV_Parser
+from hydrant.adapters.csv import ColumnarCSV_Parser, CSV_Parser, CSV_Serializer
+from hydrant.adapters.factory import (
+    adapter_by_name,
+    adapter_for,
+    parser_and_adapter,
+    sniff_format,
+)
+from hydrant.adapters.xl import ExcelParser
 from hydrant.adapters.sites.dawg import DawgPatientAdapter
 from hydrant.adapters.sites.kent import KentPatientAdapter
 from hydrant.adapters.sites.skagit import SkagitPatientAdapter, SkagitServiceRequestAdapter
+from hydrant.models.bundle import BatchUpload
+from hydrant.models.checkpoint import UploadCheckpoint
+from hydrant.models.dedup import SqliteKeyStore
 from hydrant.models.resource_list import ResourceList
 
 
@@ -49,6 +64,102 @@ def test_csv_headers(parser_skagit1_csv):
     assert not set(SkagitPatientAdapter.headers()).difference(set(parser_skagit1_csv.headers))
 
 
+class PipeStream(io.StringIO):
+    """Mock stdin style stream, can't seek"""
+    def seekable(self):
+        return False
+
+
+def test_csv_stream(datadir):
+    with open(os.path.join(datadir, 'skagit1.csv')) as f:
+        stream = PipeStream(f.read())
+    parser = CSV_Parser(stream, sniff_size=10)
+    assert parser.headers[:2] == ['Pat Last Name', 'Pat First Name']
+    pl = ResourceList(parser, SkagitPatientAdapter)
+    assert len([p for p in pl]) == 2
+
+    # streams may only be read once
+    with pytest.raises(ValueError):
+        list(parser.rows())
+
+
+def test_csv_sniff_multiline_field():
+    text = 'id,note\n0,none\n1,"Text: a; b\n c; d\n e"\n2,plain\n'
+    # sample would otherwise end within the quoted, multi-line note
+    sniff_size = len('id,note\n0,none\n1,"Text: a; b\n c; d\n')
+    parser = CSV_Parser(io.StringIO(text), sniff_size=sniff_size)
+    assert parser.headers == ['id', 'note']
+    assert [row['note'] for row in parser.rows()] == ['none', 'Text: a; b\n c; d\n e', 'plain']
+
+
+def test_csv_failed_init():
+    # as collected should __init__ fail, before any attribute is set
+    parser = ColumnarCSV_Parser.__new__(ColumnarCSV_Parser)
+    parser.__del__()
+
+
+def test_csv_mmap(datadir, parser_skagit1_csv):
+    parser = CSV_Parser(os.path.join(datadir, 'skagit1.csv'), use_mmap=True)
+    assert parser.headers == parser_skagit1_csv.headers
+    assert list(parser.rows()) == list(parser_skagit1_csv.rows())
+    # named files may be read again, reusing sniffed dialect
+    assert len(list(parser.rows())) == len(list(parser_skagit1_csv.rows()))
+
+
+def test_xlsx_parser(datadir, parser_skagit1_csv):
+    parser = ExcelParser(os.path.join(datadir, 'skagit1.xlsx'))
+    assert parser.headers == parser_skagit1_csv.headers
+    assert parser.header['Pat DOB'] == 2
+
+    rows = list(parser.rows())
+    assert rows[0]['Pat First Name'] == 'Barney'
+    assert rows[0]['Pat DOB'] == '1950-01-21'
+
+    pl = ResourceList(parser, SkagitPatientAdapter)
+    birth_dates = sorted(p.as_fhir()['birthDate'] for p in pl)
+    assert birth_dates == ['1932-04-18', '1950-01-21']
+
+
+@pytest.fixture
+def packaged_skagit1(datadir, tmp_path):
+    """skagit1.csv, packaged as each supported format"""
+    source = os.path.join(datadir, 'skagit1.csv')
+    with open(source, 'rb') as f:
+        content = f.read()
+
+    paths = {'csv': source, 'xlsx': os.path.join(datadir, 'skagit1.xlsx')}
+    paths['gzip'] = tmp_path / 'skagit1.csv.gz'
+    paths['gzip'].write_bytes(gzip.compress(content))
+    paths['zip'] = tmp_path / 'skagit1.zip'
+    with zipfile.ZipFile(paths['zip'], 'w') as archive:
+        archive.writestr('skagit1.csv', content)
+    paths['tsv'] = tmp_path / 'skagit1.tsv'
+    with open(source) as f, open(paths['tsv'], 'w') as out:
+        for row in csv.reader(f):
+            out.write('\t'.join(row) + '\n')
+    return {k: str(v) for k, v in paths.items()}
+
+
+@pytest.mark.parametrize('format_name', ('csv', 'tsv', 'gzip', 'zip', 'xlsx'))
+def test_parser_factory(packaged_skagit1, format_name):
+    filepath = packaged_skagit1[format_name]
+    assert sniff_format(filepath) == format_name
+
+    parser, adapter = parser_and_adapter(filepath)
+    assert adapter is SkagitPatientAdapter
+    pl = ResourceList(parser, adapter)
+    given = sorted(p.as_fhir()['name']['given'][0] for p in pl)
+    assert given == ['Barney', 'Fred']
+
+
+def test_adapter_registry():
+    assert adapter_by_name('KentPatientAdapter') is KentPatientAdapter
+    assert adapter_by_name('parse_datetime') is None
+    assert adapter_for(DawgPatientAdapter.headers()) is DawgPatientAdapter
+    with pytest.raises(ValueError):
+        adapter_for(['unknown'])
+
+
 def test_csv_patients(parser_skagit1_csv):
     pl = ResourceList(parser_skagit1_csv, SkagitPatientAdapter)
     for pat in pl:
@@ -58,6 +169,85 @@ def test_csv_patients(parser_skagit1_csv):
     assert len(pl) == 2
 
 
+def test_csv_serializer():
+    buffer = io.StringIO()
+    serializer = CSV_Serializer(buffer, flush_rows=2)
+    serializer.headers(['last', 'first'])
+    serializer.add_row(['Skywalker, Jr', 'Luke'])
+    # nothing written until a threshold or flush is hit
+    assert buffer.getvalue() == ''
+    serializer.add_row(['Organa', 'Leia "Princess"'])
+    serializer.add_row(['Solo', 'Han'])
+    assert buffer.getvalue().count('\n') == 3
+    serializer.close()
+    assert buffer.getvalue() == (
+        'last,first\n'
+        '"Skywalker, Jr",Luke\n'
+        'Organa,"Leia ""Princess"""\n'
+        'Solo,Han\n')
+
+
+def test_csv_serializer_gzip():
+    buffer = io.BytesIO()
+    serializer = CSV_Serializer(buffer, compress=True)
+    serializer.headers(['last', 'first'])
+    serializer.add_row(['Skywalker', 'Luke'])
+    serializer.close()
+    assert gzip.decompress(buffer.getvalue()) == b'last,first\nSkywalker,Luke\n'
+
+
+def test_skagit_from_resource():
+    patient = {
+        'resourceType': 'Patient',
+        'name': [{'family': 'Skywalker', 'given': ['Luke']}],
+        'birthDate': '1951-09-25'}
+    row = SkagitPatientAdapter(parsed_row=None).from_resource(patient)
+    assert row == ['Skywalker', 'Luke', '1951-09-25', '']
+    assert SkagitPatientAdapter.compiled_fhir_paths() is SkagitPatientAdapter.compiled_fhir_paths()
+
+
+def test_adapter_memoized(mocker):
+    parse = mocker.patch(
+        'hydrant.adapters.sites.skagit.parse_datetime',
+        return_value=datetime(1966, 1, 1))
+    adapter = SkagitPatientAdapter({
+        'Pat Last Name': 'Potter', 'Pat First Name': 'Harry', 'Pat DOB': '01/01/66'})
+    adapter.unique_key()
+    resource = SkagitPatientAdapter.RESOURCE_CLASS.from_adapter(adapter)
+    assert resource.as_fhir()['birthDate'] == '1966-01-01'
+    assert parse.call_count == 1
+
+    # slots keep the per row footprint small
+    assert not hasattr(adapter, '__dict__')
+
+
+def test_columnar_parser(datadir):
+    filepath = os.path.join(datadir, 'skagit_service_requests.csv')
+    columns = dict(
+        date_columns=SkagitServiceRequestAdapter.DATE_HEADERS,
+        name_columns=SkagitServiceRequestAdapter.NAME_HEADERS)
+    parser = ColumnarCSV_Parser(filepath, chunk_size=2, **columns)
+    rows = list(parser.rows())
+    raw = list(CSV_Parser(filepath).rows())
+    assert len(rows) == len(raw)
+    assert dict(rows[0]) == dict(raw[0], **{'Pat DOB': '2045-01-15', 'Order Date': '2020-07-22'})
+    assert 'Pat DOB' in rows[0]
+
+    # both parsers normalize alike
+    expected = list(CSV_Parser(filepath, **columns).rows())
+    assert [dict(row) for row in rows] == expected
+
+
+def test_columnar_patients(datadir):
+    parser = ColumnarCSV_Parser(
+        os.path.join(datadir, 'dups.csv'),
+        date_columns=SkagitPatientAdapter.DATE_HEADERS,
+        name_columns=SkagitPatientAdapter.NAME_HEADERS)
+    pl = ResourceList(parser, SkagitPatientAdapter)
+    birth_dates = [patient.as_fhir()['birthDate'] for patient in pl]
+    assert sorted(birth_dates) == ['1966-01-01', '1972-11-25']
+
+
 def test_service_request_headers(skagit_service_requests):
     assert not set(SkagitServiceRequestAdapter.headers()).difference(set(skagit_service_requests.headers))
 
@@ -105,6 +295,95 @@ def test_dups_example(parser_dups_csv):
     assert len(pl) == 2
 
 
+def test_dups_multiprocess(parser_dups_csv):
+    pl = ResourceList(parser_dups_csv, SkagitPatientAdapter, processes=2, chunk_size=2)
+    families = [patient.as_fhir()['name']['family'] for patient in pl]
+    # merged in row order, dropping the same duplicates
+    assert families == [
+        p.as_fhir()['name']['family'] for p in ResourceList(parser_dups_csv, SkagitPatientAdapter)]
+    assert len(pl) == 2
+
+
+def test_multiprocess_bounded_read(example_csv):
+    rows_parsed = []
+
+    class CountingParser(object):
+        def rows(self):
+            for row in example_csv.rows():
+                rows_parsed.append(row)
+                yield row
+
+    pl = ResourceList(CountingParser(), SkagitPatientAdapter, processes=2, chunk_size=1)
+    resources = iter(pl)
+    next(resources)
+    # read ahead limited to two chunks per worker process
+    assert len(rows_parsed) == 4
+    assert len(list(resources)) == 9
+
+
+def test_dups_sqlite_store(parser_dups_csv):
+    pl = ResourceList(parser_dups_csv, SkagitPatientAdapter, key_store=SqliteKeyStore)
+    families = [patient.as_fhir()['name']['family'] for patient in pl]
+    assert sorted(families) == ["Granger", "Potter"]
+    assert len(pl) == 2
+
+
+def test_sqlite_store_existing(tmpdir):
+    path = str(tmpdir.join('keys.sqlite'))
+    store = SqliteKeyStore(path)
+    assert store.add(('Potter', ('Harry',), '1980-07-31'))
+    store.close()
+
+    # keys of a previous run aren't reused, nor silently dropped
+    with pytest.raises(ValueError):
+        SqliteKeyStore(path)
+
+
+def test_upload_checkpoint_resume(datadir, requests_mock, tmpdir):
+    filename = os.path.join(datadir, 'example.csv')
+    checkpoint_path = str(tmpdir.join('checkpoint.json'))
+    outage = {'after': 2}
+
+    def respond(request, context):
+        # simulate an outage once `after` bundles are posted
+        if outage['after'] is not None and post.call_count > outage['after']:
+            context.status_code = 503
+            return {'resourceType': 'OperationOutcome', 'issue': []}
+        return {'resourceType': 'Bundle'}
+
+    post = requests_mock.post('http://fhir.test/fhir', json=respond)
+    checkpoint = UploadCheckpoint(checkpoint_path, filename)
+    batcher = BatchUpload('http://fhir.test/fhir', batch_size=3, checkpoint=checkpoint)
+    with pytest.raises(Exception):
+        batcher.process(ResourceList(CSV_Parser(filename), SkagitPatientAdapter))
+    assert batcher.bundles_committed == 2
+
+    # resume skips the rows of both committed bundles
+    checkpoint = UploadCheckpoint(checkpoint_path, filename)
+    start_row = checkpoint.load()
+    assert (checkpoint.bundles, start_row) == (2, 6)
+    resources = ResourceList(CSV_Parser(filename), SkagitPatientAdapter, start_row=start_row)
+    batcher = BatchUpload('http://fhir.test/fhir', batch_size=3, checkpoint=checkpoint)
+    outage['after'] = None
+    batcher.process(resources)
+    assert batcher.total_sent == 4
+    assert batcher.bundles_committed == 4
+    assert resources.rows_read == 10
+
+    # checkpoint is only valid for the input it was saved for
+    with pytest.raises(ValueError):
+        UploadCheckpoint(checkpoint_path, os.path.join(datadir, 'dups.csv')).load()
+    with pytest.raises(ValueError):
+        UploadCheckpoint(checkpoint_path, '-')
+
+
+def test_unique_key_compact(parser_dups_csv):
+    row = next(parser_dups_csv.rows())
+    key = SkagitPatientAdapter(row).unique_key()
+    assert isinstance(key, tuple)
+    hash(key)
+
+
 @pytest.mark.skip(reason="lack ability to mock patients in HAPI")
 def test_skagit_service_requests(skagit_service_requests):
     srl = ResourceList(skagit_service_requests, SkagitServiceRequestAdapter)
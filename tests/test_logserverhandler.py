@@ -0,0 +1,100 @@
+import logging
+import pytest
+import threading
+import time
+
+from hydrant.logserverhandler import (
+    BatchingLogServerHandler,
+    EventShipper,
+    LogServerHandler,
+)
+
+
+@pytest.fixture
+def batching_logger(requests_mock):
+    requests_mock.post('http://logs.test/events', status_code=201)
+    handler = BatchingLogServerHandler(
+        url='http://logs.test', jwt='token', batch_size=3, flush_interval=60)
+    logger = logging.getLogger('test_batching_logger')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    yield logger, handler
+    logger.removeHandler(handler)
+    handler.close()
+
+
+def test_batched_events(batching_logger, requests_mock):
+    logger, handler = batching_logger
+    for i in range(4):
+        logger.info(f"event {i}")
+    handler.flush()
+
+    # first three sent on batch size, remainder on flush
+    batches = [r.json() for r in requests_mock.request_history]
+    assert [len(b) for b in batches] == [3, 1]
+    assert batches[0][0]['event']['message'] == 'event 0'
+    assert requests_mock.last_request.headers['Authorization'] == 'Bearer token'
+    # log server timeout, not that of the FHIR server
+    assert requests_mock.last_request.timeout == 10.0
+    assert handler.sent == 4
+
+
+def test_close_sends_queued(batching_logger, requests_mock):
+    logger, handler = batching_logger
+    logger.info("last words")
+    handler.close()
+    assert requests_mock.call_count == 1
+    assert not handler._worker.is_alive()
+
+
+def test_ship_events(requests_mock):
+    requests_mock.post('http://logs.test/events', status_code=201)
+    shipper = EventShipper(
+        LogServerHandler(url='http://logs.test', jwt='token'), batch_size=4, max_in_flight=2)
+    events = ({'type': 'LOGIN', 'user_id': str(i)} for i in range(10))
+    assert shipper.ship(events) == 10
+    batches = [r.json() for r in requests_mock.request_history]
+    assert sorted(len(b) for b in batches) == [2, 4, 4]
+    assert {'event': {'type': 'LOGIN', 'user_id': '0'}} in batches[0] + batches[1] + batches[2]
+    assert requests_mock.last_request.headers['Authorization'] == 'Bearer token'
+
+
+def test_ship_events_retry(requests_mock):
+    requests_mock.post('http://logs.test/events', [
+        {'status_code': 503}, {'status_code': 201}, {'status_code': 503}])
+    shipper = EventShipper(
+        LogServerHandler(url='http://logs.test', jwt='token'),
+        batch_size=2, max_in_flight=1, retries=1, backoff_factor=0)
+    events = ({'type': 'LOGIN', 'user_id': str(i)} for i in range(6))
+    # first batch sent on retry, second fails both attempts, third never sent
+    assert shipper.ship(events) == 2
+    assert shipper.failed == 2
+    assert requests_mock.call_count == 4
+
+
+def test_close_full_queue(mocker):
+    # worker stuck transmitting, with a full queue behind it
+    release = threading.Event()
+    transmit = mocker.patch.object(
+        BatchingLogServerHandler, 'transmit', side_effect=lambda batch: release.wait())
+    handler = BatchingLogServerHandler(
+        url='http://logs.test', jwt='token', batch_size=1, flush_interval=60, max_queue=1)
+    logger = logging.getLogger('test_close_full_queue')
+    logger.addHandler(handler)
+    logger.warning("stuck")
+    while not transmit.called:
+        time.sleep(0.01)
+    logger.warning("queued")
+    logger.warning("dropped")
+    assert handler.dropped == 1
+
+    # neither blocks on nor raises for the full queue
+    handler.flush(timeout=0.1)
+    handler.close(timeout=0.1)
+    logger.removeHandler(handler)
+
+    # queued record still sent, once the worker is free
+    release.set()
+    handler._worker.join(timeout=5)
+    assert not handler._worker.is_alive()
+    assert transmit.call_count == 2
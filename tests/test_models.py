@@ -1,15 +1,31 @@
+from contextlib import closing
 from datetime import date, datetime
+import gzip
+import io
+from flask import Flask
 import json
 import pytest
 from urllib.parse import parse_qs, urlparse
 
-from hydrant.models.bundle import Bundle
-from hydrant.models.datetime import parse_datetime
+from requests.exceptions import HTTPError
+
+from hydrant import fhir_client
+from hydrant.models.bundle import BatchUpload, Bundle, SearchError, SearchsetPages
+from hydrant.models.datetime import normalize_date_string, parse_datetime
 from hydrant.models.document_reference import (
     CONTROLLED_SUBSTANCE_AGREEMENT_CODE,
     DocumentReference,
 )
-from hydrant.models.patient import Patient
+from hydrant.models.kc_log_extractor import (
+    EventMark,
+    close_pool,
+    get_con,
+    get_events,
+    write_events,
+)
+from hydrant.models.ledger import UploadLedger
+from hydrant.models.patient import Patient, PatientCache, patient_cache
+from hydrant.models.rejects import RejectFile
 from hydrant.models.service_request import ServiceRequest
 
 
@@ -39,6 +55,95 @@ def test_patient_params(mock_patient):
     assert qs['given'][0] == mock_patient._fields["name"]["given"][0]
 
 
+def test_patient_cache_lru():
+    cache = PatientCache(maxsize=2)
+    cache.set(('a', 'b', '2000-01-01'), '1')
+    cache.set(('c', 'd', '2000-01-01'), '2')
+    # touch first key, so second is least recently used
+    assert cache.get(('a', 'b', '2000-01-01')) == '1'
+    cache.set(('e', 'f', '2000-01-01'), '3')
+    assert len(cache) == 2
+    assert ('c', 'd', '2000-01-01') not in cache
+
+    # misses only retained when requested
+    cache.set(('g', 'h', '2000-01-01'), None)
+    assert ('g', 'h', '2000-01-01') not in cache
+
+
+def test_patient_cache_lookup(mocker, requests_mock):
+    mocker.patch('hydrant.models.resource.FHIR_SERVER_URL', 'http://fhir.test/fhir')
+    found = requests_mock.get('http://fhir.test/fhir/Patient/?family=Brown', json={
+        'resourceType': 'Bundle',
+        'total': 1,
+        'entry': [{'resource': {'resourceType': 'Patient', 'id': '9'}}]})
+    name = {'family': 'Brown', 'given': ['Charlie Jr']}
+
+    with patient_cache(cache_misses=True) as cache:
+        for _ in range(3):
+            assert Patient(name=name, birthDate='1948-05-30').id() == '9'
+        assert cache.hits == 2
+
+    # without an active cache, every lookup is a round trip
+    Patient(name=name, birthDate='1948-05-30').id()
+    assert found.call_count == 2
+
+
+def test_patient_cache_prefetch(requests_mock):
+    def searchset(*ids):
+        return {
+            'resource': {
+                'resourceType': 'Bundle',
+                'total': len(ids),
+                'entry': [{'resource': {'resourceType': 'Patient', 'id': i}} for i in ids]},
+            'response': {'status': '200 OK'}}
+
+    batch = requests_mock.post('http://fhir.test/fhir', json={
+        'resourceType': 'Bundle',
+        'type': 'batch-response',
+        'entry': [searchset('9'), searchset(), searchset('10', '11')]})
+    patients = [
+        Patient(name={'family': 'Brown', 'given': ['Charlie']}, birthDate='1948-05-30'),
+        Patient(name={'family': 'Van Pelt', 'given': ['Lucy']}, birthDate='1950-01-01'),
+        Patient(name={'family': 'Van Pelt', 'given': ['Linus']}, birthDate='1952-01-01'),
+    ]
+
+    cache = PatientCache(cache_misses=True)
+    assert cache.prefetch(patients, 'http://fhir.test/fhir', batch_size=5) == 3
+    request = batch.last_request.json()
+    assert request['type'] == 'batch'
+    assert request['entry'][0]['request']['method'] == 'GET'
+
+    assert cache.get(patients[0].cache_key()) == '9'
+    assert cache.get(patients[1].cache_key()) is None
+    # ambiguous matches are left for the individual lookup to raise
+    assert patients[2].cache_key() not in cache
+
+    # cached patients aren't requested again
+    assert cache.prefetch(patients[:2], 'http://fhir.test/fhir') == 0
+
+
+def test_patient_cache_prefetch_no_server(requests_mock):
+    cache = PatientCache()
+    patients = [Patient(name={'family': 'Brown', 'given': ['Charlie']}, birthDate='1948-05-30')]
+    assert cache.prefetch(patients, target_system=None) == 0
+    assert not requests_mock.called
+
+
+def test_fhir_client_session(requests_mock):
+    requests_mock.get('http://fhir.test/fhir/metadata', json={})
+    fhir_client.get('http://fhir.test/fhir/metadata')
+    fhir_client.get('http://fhir.test/fhir/metadata', timeout=1)
+
+    # one pooled session shared by all requests
+    assert fhir_client.session() is fhir_client.session()
+    adapter = fhir_client.session().get_adapter('https://fhir.test')
+    assert 503 in adapter.max_retries.status_forcelist
+
+    default_timeout, given_timeout = [r.timeout for r in requests_mock.request_history]
+    assert default_timeout == (fhir_client.FHIR_CONNECT_TIMEOUT, fhir_client.FHIR_READ_TIMEOUT)
+    assert given_timeout == 1
+
+
 def test_date_parse():
     ex = '1/21/1950'
     result = parse_datetime(ex)
@@ -60,6 +165,32 @@ def test_2d_year_wrap():
     assert result.year == 2001
 
 
+@pytest.mark.parametrize('value, expected', (
+    ('01/21/1950', date(1950, 1, 21)),
+    ('1950-01-21', date(1950, 1, 21)),
+    ('01-15-45', date(1945, 1, 15)),
+    # 4 digit years beyond WRAP_YEAR are also wrapped
+    ('2030-06-01', date(1930, 6, 1)),
+    # day first, left to dateutil
+    ('21/01/1950', date(1950, 1, 21)),
+    ('January 21, 1950', date(1950, 1, 21)),
+))
+def test_date_parse_formats(value, expected):
+    assert parse_datetime(value).date() == expected
+
+
+@pytest.mark.parametrize('value', (
+    '01/21/1950', '01-15-45', '2030-06-01', '2130-06-01', '21/01/1950'))
+def test_normalize_date_string(value):
+    # years are wrapped once, when the normalized value is parsed
+    assert parse_datetime(normalize_date_string(value)) == parse_datetime(value)
+
+
+def test_date_parse_pre_1900():
+    with pytest.raises(ValueError):
+        parse_datetime('12/31/1899')
+
+
 def test_patient_bundle():
     bundle = Bundle()
     patient = Patient()
@@ -69,6 +200,183 @@ def test_patient_bundle():
     json.dumps(bundle.as_fhir())
 
 
+def mock_patients(count):
+    return [
+        Patient(name={'family': f'Family{i}', 'given': ['Given']}, birthDate='1950-01-01')
+        for i in range(count)]
+
+
+def test_concurrent_upload(requests_mock):
+    post = requests_mock.post('http://fhir.test/fhir', json={'resourceType': 'Bundle'})
+    batcher = BatchUpload('http://fhir.test/fhir', batch_size=2, max_in_flight=3)
+    batcher.process(mock_patients(9))
+    assert batcher.total_sent == 9
+    assert post.call_count == 5
+    assert not batcher._in_flight
+
+
+def test_concurrent_upload_error(requests_mock):
+    def respond(request, context):
+        if 'Family4' in request.text:
+            context.status_code = 400
+            return {'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error'}]}
+        return {'resourceType': 'Bundle'}
+
+    requests_mock.post('http://fhir.test/fhir', json=respond)
+    batcher = BatchUpload('http://fhir.test/fhir', batch_size=2, max_in_flight=2)
+    with pytest.raises(HTTPError):
+        batcher.process(mock_patients(6))
+    # only the failing bundle is missing from the tally
+    assert batcher.total_sent == 4
+    assert not batcher._in_flight
+
+
+def test_adaptive_bundle_size(requests_mock):
+    post = requests_mock.post('http://fhir.test/fhir', json={'resourceType': 'Bundle'})
+    batcher = BatchUpload(
+        'http://fhir.test/fhir', batch_size=2, min_batch_size=1, max_batch_size=6)
+    batcher.process(mock_patients(20))
+    assert batcher.total_sent == 20
+    # grown with each fast transaction, to the upper bound
+    assert [len(r.json()['entry']) for r in post.request_history] == [2, 3, 4, 5, 6]
+    assert batcher.batch_size == 6
+
+    # capped by payload size
+    bytes_per_entry = len(post.last_request.body) / 6
+    batcher = BatchUpload(
+        'http://fhir.test/fhir', batch_size=6, min_batch_size=1, max_batch_size=20,
+        max_bundle_bytes=int(bytes_per_entry * 3.5))
+    batcher.process(mock_patients(6))
+    assert batcher.batch_size == 3
+
+
+def test_adaptive_split_failures(requests_mock):
+    def respond(request, context):
+        if 'Family5' in request.text:
+            context.status_code = 500
+            return {'resourceType': 'OperationOutcome', 'issue': []}
+        return {'resourceType': 'Bundle'}
+
+    requests_mock.post('http://fhir.test/fhir', json=respond)
+    batcher = BatchUpload(
+        'http://fhir.test/fhir', batch_size=8, min_batch_size=2, max_batch_size=8)
+    batcher.process(mock_patients(10))
+    # failing entry isolated, the rest sent
+    assert batcher.total_failed == 1
+    assert batcher.total_sent == 9
+    assert batcher.bundles_committed == 2
+    # size backed off by the failure (to 2), not regrown by the bisected
+    # parts, only by the last (top level) bundle
+    assert batcher.batch_size == 3
+
+
+def test_adaptive_outage(requests_mock):
+    post = requests_mock.post('http://fhir.test/fhir', status_code=503, text='unavailable')
+    batcher = BatchUpload(
+        'http://fhir.test/fhir', batch_size=4, min_batch_size=1, max_batch_size=8,
+        retries=2, backoff_factor=0)
+    with pytest.raises(HTTPError):
+        batcher.process(mock_patients(4))
+    # retried whole, never bisected nor entries marked failed
+    assert post.call_count == 3
+    assert batcher.total_failed == 0
+    assert batcher.bundles_committed == 0
+
+
+def test_adaptive_transient_unavailable(requests_mock):
+    post = requests_mock.post('http://fhir.test/fhir', [
+        {'status_code': 502, 'text': 'bad gateway'},
+        {'json': {'resourceType': 'Bundle'}}])
+    batcher = BatchUpload(
+        'http://fhir.test/fhir', batch_size=4, min_batch_size=1, max_batch_size=8,
+        backoff_factor=0)
+    batcher.process(mock_patients(4))
+    assert post.call_count == 2
+    assert batcher.total_sent == 4
+
+
+def test_batch_bundle_rejects(requests_mock, tmpdir):
+    def respond(request, context):
+        bundle = request.json()
+        assert bundle['type'] == 'batch'
+        results = []
+        for entry in bundle['entry']:
+            if entry['resource']['name']['family'] == 'Family3':
+                outcome = {'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error'}]}
+                results.append({'response': {'status': '422 Unprocessable Entity', 'outcome': outcome}})
+            elif entry['resource']['name']['family'] == 'Family6':
+                # malformed, without response
+                results.append({})
+            else:
+                results.append({'response': {'status': '201 Created'}})
+        return {'resourceType': 'Bundle', 'type': 'batch-response', 'entry': results}
+
+    requests_mock.post('http://fhir.test/fhir', json=respond)
+    reject_path = tmpdir.join('rejects.ndjson')
+    with RejectFile(str(reject_path)) as rejects:
+        batcher = BatchUpload(
+            'http://fhir.test/fhir', batch_size=4, bundle_type='batch', rejects=rejects)
+        batcher.process(mock_patients(8))
+    assert batcher.total_sent == 6
+    assert batcher.total_failed == 2
+    rejected = [json.loads(line) for line in reject_path.readlines()]
+    assert len(rejected) == 2
+    assert rejected[1]['outcome'] is None
+    assert rejected[0]['status'].startswith('422')
+    assert rejected[0]['resource']['name']['family'] == 'Family3'
+    assert rejected[0]['outcome']['resourceType'] == 'OperationOutcome'
+
+
+def test_transaction_bisect_rejects(requests_mock, tmpdir):
+    def respond(request, context):
+        if 'Family2' in request.text or 'Family5' in request.text:
+            context.status_code = 400
+            return {'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error'}]}
+        return {'resourceType': 'Bundle'}
+
+    post = requests_mock.post('http://fhir.test/fhir', json=respond)
+    reject_path = tmpdir.join('rejects.ndjson')
+    with RejectFile(str(reject_path)) as rejects:
+        batcher = BatchUpload('http://fhir.test/fhir', batch_size=8, rejects=rejects)
+        batcher.process(mock_patients(8))
+    assert batcher.total_sent == 6
+    assert batcher.total_failed == 2
+    assert batcher.bundles_committed == 1
+    assert [json.loads(line)['resource']['name']['family'] for line in reject_path.readlines()] == [
+        'Family2', 'Family5']
+    # bisected: 8 -> 4, 4 -> 2, 2, 2 -> 1, 1, 2 -> 1, 1
+    assert post.call_count == 11
+
+
+def test_ledger_upload(requests_mock, tmpdir):
+    post = requests_mock.post('http://fhir.test/fhir', json={'resourceType': 'Bundle'})
+    ledger_path = str(tmpdir.join('ledger.sqlite'))
+    with UploadLedger(ledger_path, 'http://fhir.test/fhir') as ledger:
+        batcher = BatchUpload('http://fhir.test/fhir', batch_size=2, ledger=ledger)
+        batcher.process(mock_patients(3))
+        assert batcher.total_sent == 3
+        assert len(ledger) == 3
+
+    # unchanged resources skipped on next upload, changed sent
+    patients = mock_patients(4)
+    patients[0]._fields['gender'] = 'female'
+    with UploadLedger(ledger_path, 'http://fhir.test/fhir') as ledger:
+        batcher = BatchUpload('http://fhir.test/fhir', batch_size=2, ledger=ledger)
+        batcher.process(patients)
+        assert batcher.total_unchanged == 2
+        assert batcher.total_sent == 2
+        assert post.call_count == 3
+
+        # force resends all
+        batcher = BatchUpload('http://fhir.test/fhir', batch_size=2, ledger=ledger, force=True)
+        batcher.process(patients)
+        assert batcher.total_sent == 4
+
+    # ledger is scoped to the target system
+    with UploadLedger(ledger_path, 'http://other.test/fhir') as ledger:
+        assert len(ledger) == 0
+
+
 def test_service_request(mock_patient):
     # Mock ServiceRequest with code
     codeable_concept = {"coding": [{'system': 'http://loinc.org', 'code': 'chicken'}]}
@@ -114,3 +422,123 @@ def test_document_reference(mock_patient):
     assert(qs['subject'] == ['Patient/9'])
     assert(qs['type'] == ['https://loinc.org|94136-9'])
     assert(qs['date'] == ['2020-10-10'])
+
+
+@pytest.mark.parametrize('read_ahead', (0, 2))
+def test_searchset_pages(requests_mock, read_ahead):
+    def page(n, last=False):
+        bundle = {
+            'resourceType': 'Bundle',
+            'entry': [{'resource': {'resourceType': 'Patient', 'id': str(n)}}]}
+        if not last:
+            # `next` links reference an alternate host, same request path
+            bundle['link'] = [{
+                'relation': 'next',
+                'url': f'http://dashboard.test/fhir?_getpages=x&_getpagesoffset={n + 1}'}]
+        return bundle
+
+    requests_mock.get('http://fhir.test/fhir/Patient', json=page(0))
+    for n in range(1, 5):
+        requests_mock.get(
+            f'http://fhir.test/fhir?_getpages=x&_getpagesoffset={n}', json=page(n, last=n == 4))
+
+    pages = SearchsetPages('http://fhir.test/fhir/Patient', 'http://fhir.test/fhir', read_ahead)
+    ids = [bundle['entry'][0]['resource']['id'] for bundle in pages]
+    assert ids == ['0', '1', '2', '3', '4']
+
+
+def test_searchset_pages_error(requests_mock):
+    requests_mock.get('http://fhir.test/fhir/Patient', status_code=502, text='Bad Gateway')
+    with pytest.raises(SearchError):
+        list(SearchsetPages('http://fhir.test/fhir/Patient', 'http://fhir.test/fhir'))
+
+
+@pytest.mark.parametrize("ndjson", (False, True))
+def test_write_events(ndjson):
+    events = [
+        {'user_id': 'u1', 'type': 'LOGIN', 'details': {'username': 'barney'}},
+        {'user_id': 'u2', 'type': 'LOGOUT', 'details': {}},
+    ]
+    buffer = io.StringIO()
+    assert write_events(iter(events), buffer, ndjson=ndjson) == 2
+    if ndjson:
+        assert [json.loads(line) for line in buffer.getvalue().splitlines()] == events
+    else:
+        assert buffer.getvalue() == json.dumps(events, indent=2) + '\n'
+
+    compressed = io.BytesIO()
+    write_events(iter(events), compressed, ndjson=ndjson, compress=True)
+    assert gzip.decompress(compressed.getvalue()).decode('utf-8') == buffer.getvalue()
+
+
+def test_incremental_events(mocker, tmpdir):
+    state_file = str(tmpdir.join('kc_events.json'))
+    mark = EventMark(state_file)
+    assert mark.position is None
+
+    # named (server side) cursor yields events, others the username map
+    cursor = mocker.MagicMock()
+    cursor.__iter__.side_effect = lambda: iter([
+        ('u1', 's1', 1600000000000, 'LOGIN', '{"username": "barney"}', 'b'),
+        ('u1', 's1', 1600000000000, 'LOGOUT', '{}', 'a'),
+    ])
+    map_cursor = mocker.MagicMock()
+    map_cursor.__iter__.side_effect = lambda: iter([('u1', '{"username": "barney"}')])
+    db_con = mocker.MagicMock()
+    db_con.cursor.side_effect = lambda name=None: mocker.MagicMock(
+        __enter__=mocker.Mock(return_value=cursor if name else map_cursor))
+
+    events = list(get_events(db_con, mark=mark))
+    assert [e['type'] for e in events] == ['LOGIN', 'LOGOUT']
+    assert events[1]['user_name'] == 'barney'
+    # mark only persisted once saved
+    assert EventMark(state_file).position is None
+    mark.save()
+
+    mark = EventMark(state_file)
+    assert mark.position == (1600000000000, 'b')
+    list(get_events(db_con, mark=mark))
+    query, params = cursor.execute.call_args[0]
+    assert "(event_time, id) > (%s, %s)" in query
+    assert tuple(params) == (1600000000000, 'b')
+
+
+def test_events_closed_early(mocker):
+    named_cursor = mocker.MagicMock()
+    named_cursor.__enter__.return_value.__iter__.side_effect = lambda: iter([
+        ('u1', 's1', 1600000000000, 'LOGIN', '{}', 'a'),
+        ('u1', 's1', 1600000000001, 'LOGOUT', '{}', 'b'),
+    ])
+    db_con = mocker.MagicMock()
+    db_con.cursor.side_effect = lambda name=None: named_cursor if name else mocker.MagicMock()
+
+    with closing(get_events(db_con)) as events:
+        next(events)
+        named_cursor.__exit__.assert_not_called()
+    # abandoned part way, cursor closed before the connection is released
+    named_cursor.__exit__.assert_called_once()
+
+
+def test_kc_connection_pool(mocker):
+    pool_class = mocker.patch('hydrant.models.kc_log_extractor.ThreadedConnectionPool')
+    pool = pool_class.return_value
+    pool.closed = False
+    pool.getconn.return_value.closed = 0
+    app = Flask('test')
+    app.config.from_object('hydrant.config')
+    with app.app_context():
+        with get_con() as db_con:
+            assert db_con is pool.getconn.return_value
+        with pytest.raises(RuntimeError):
+            with get_con():
+                raise RuntimeError("query failed")
+
+    # one pool, from DB_* config, each connection returned
+    assert pool_class.call_count == 1
+    assert 'statement_timeout' in pool_class.call_args[1]['options']
+    assert pool.putconn.call_count == 2
+    db_con.commit.assert_called_once()
+    db_con.rollback.assert_called_once()
+
+    close_pool()
+    pool.closeall.assert_called_once()